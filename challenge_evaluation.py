@@ -25,19 +25,38 @@ The local_qasm_cpp_simulator that is used requires QISKit 0.43 or later.
 """
 
 import numpy as np
+import networkx as nx
+import re
+import sympy
 import time
 import copy
 import qiskit
 import sys, os, traceback
+import json
+import signal
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 GLOBAL_TIMEOUT = 3600
 ERROR_LIMIT = 1e-10
-from qiskit import QuantumProgram
+INVERSE_INPUTS = 2  # random product states checked by _verify_by_inverse
+BASIS_GATES = 'u1,u2,u3,cx,id'  # or use "U,CX?"
+GATE_COSTS = {'id': 0, 'u1': 0, 'measure': 0, 'reset': 0, 'barrier': 0,
+              'u2': 1, 'u3': 1, 'U': 1,
+              'cx': 10, 'CX': 10}
 from qiskit.unroll import Unroller, DAGBackend
+from qiskit.dagcircuit import DAGCircuit
+from functools import lru_cache
 from qiskit._openquantumcompiler import dag2json
-from multiprocessing import Pool
+from qiskit._jobprocessor import run_backend
+from qiskit import QuantumJob
+from multiprocessing import Pipe, Pool, Process
+from multiprocessing.connection import wait
 from qiskit.mapper._mappererror import MapperError
 from qiskit.tools.qi.qi import state_fidelity
+from result_cache import ResultCache, code_fingerprint
 
 
 
@@ -92,7 +111,8 @@ def score(compiler_function=None,backend = 'local_qiskit_simulator'):
     return (1./np.mean([ii[0] for ii in res_scores]), 1./np.mean([ii[1] for ii in res_scores]))
 
 
-def evaluate(compiler_function=None, test_circuits=None, verbose=False, backend = 'local_qiskit_simulator'):
+def evaluate(compiler_function=None, test_circuits=None, verbose=False, backend = 'local_qiskit_simulator',
+             cache_dir=None, processes=None, chunksize=1, timeout=GLOBAL_TIMEOUT, verifier='simulator'):
     """
     Evaluates the given complier_function with the circuits in test_circuits
     and compares the output circuit and quantum state with the original and
@@ -112,6 +132,20 @@ def evaluate(compiler_function=None, test_circuits=None, verbose=False, backend
         verbose (bool): specifies if performance of basic QISKit unroler and mapper circuit is shown for each circuit
         backend (string): backend to use. For Windows Systems you should specify 'local_qasm_simulator' until
                          'local_qiskit_simulator' is available.
+        cache_dir (string): if given, the compiled circuits of both compilers are cached in this
+                            directory and a circuit is only compiled if the cache has no result for
+                            it, its coupling map, the gate costs and the code of the compiler. The
+                            reported times are the ones of the original compilations.
+        processes (int): number of worker processes, the number of CPUs if None
+        chunksize (int): number of circuits sent to a worker at once
+        timeout (float): if given, a circuit whose evaluation takes longer than this many seconds
+                         is stopped and counted as failed, with "timed_out" set in its results.
+                         Only available on platforms with SIGALRM
+        verifier (string): how the state of the optimized circuit is checked. 'simulator' compares
+                           the states computed by the backend. 'inverse' runs the original circuit
+                           and then the inverse of the optimized one on a single state vector,
+                           for the all zero state and random product states, see
+                           _verify_by_inverse, which needs much less memory for many qubits
 
 
 
@@ -133,187 +167,197 @@ def evaluate(compiler_function=None, test_circuits=None, verbose=False, backend
                 "coupling_correct_optimized": (bool) does optimized circuit
                                                     satisfy the coupling map,
                 "state_correct_optimized": (bool) does optimized circuit
-                                                  return correct state
+                                                  return correct state,
+                "sim_time_orig": time taken by the simulation of the original circuit,
+                "sim_time_opti": time taken by the simulation of the optimized circuit
             }
         }
     """
     # Initial Setup
-    basis_gates = 'u1,u2,u3,cx,id'  # or use "U,CX?"
-    gate_costs = {'id': 0, 'u1': 0, 'measure': 0, 'reset': 0, 'barrier': 0,
-                  'u2': 1, 'u3': 1, 'U': 1,
-                  'cx': 10, 'CX': 10}
+    basis_gates = BASIS_GATES
+    gate_costs = GATE_COSTS
     # Results data structure
-    results = {}
-    # Load QASM files and extract DAG circuits
-    for name, circuit in test_circuits.items():
-        qp = QuantumProgram()
-        qp.load_qasm_text(
-            circuit["qasm"], name, basis_gates=basis_gates)
-        circuit["dag_original"] = qasm_to_dag_circuit(circuit["qasm"], basis_gates=basis_gates)
-        test_circuits[name] = circuit
-        results[name] = {}  # build empty result dict to be filled later
+    results = {name: {} for name in test_circuits}  # build empty result dicts to be filled later
 
     # Only return results if a valid compiler function is provided
-    if compiler_function is not None:
-        # step through all the test circuits using multiprocessing
-        compile_jobs = [[name,circuit,0,compiler_function,gate_costs] for name, circuit in test_circuits.items()]
-        with Pool(len(compile_jobs)) as job:
-            res_values_opt = job.map(_compile_circuits, compile_jobs)
-        # stash the results in the respective dicts
-        for job in range(len(compile_jobs)):
-            name = res_values_opt[job].pop("name")
-            test_circuits[name] = res_values_opt[job].pop("circuit") # remove the circuit from the results and store it
-            results[name] = res_values_opt[job]
-        # do the same for the reference compiler in qiskit if verbose == True
-        if verbose:
-            compile_jobs = [[name, circuit, 1, _qiskit_compiler, gate_costs] for name, circuit in
-                            test_circuits.items()]
-            with Pool(len(compile_jobs)) as job:
-                res_values = job.map(_compile_circuits, compile_jobs)
-            # also stash this but use update so we don't overwrite anything
-            for job in range(len(compile_jobs)):
-                name = res_values[job].pop("name")
-                test_circuits[name].update(res_values[job].pop("circuit")) # remove the circuit from the results and store it
-                results[name].update(res_values[job])
-
-
-        # determine the final permutation of the qubits
-        # this is done by analyzing the measurements on the qubits
-        compile_jobs = [[name, circuit, verbose] for name, circuit in test_circuits.items()]
-        with Pool(len(compile_jobs)) as job:
-            res_values = job.map(_prep_sim, compile_jobs)
-
-        for job in range(len(compile_jobs)):
-            name = res_values[job].pop("name")
-            test_circuits[name].update(res_values[job].pop("circuit")) # remove the circuit from the results and store it
-            results[name].update(res_values[job])
-
-        # Compose qobj for simulation
-        config = {
-            'data': ['quantum_state'],
-        }
+    if compiler_function is None:
+        # Load QASM files and extract DAG circuits
+        for name, circuit in test_circuits.items():
+            circuit["dag_original"] = qasm_to_dag_circuit(circuit["qasm"], basis_gates=basis_gates)
+        return results
+
+    # Each circuit is compiled, simulated and verified by one worker process, which returns only
+    # the metrics. So the simulations run in parallel and no circuits or states are sent back
+    eval_jobs = [[name, circuit["qasm"], circuit["coupling_map"], compiler_function, gate_costs,
+                  basis_gates, backend, verbose, cache_dir, verifier, timeout]
+                 for name, circuit in test_circuits.items()]
+    # The largest circuits first, so that a long one does not start last and keep the other
+    # workers idle at the end
+    eval_jobs.sort(key=lambda eval_job: len(eval_job[1]), reverse=True)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    with Pool(max(1, min(processes, len(eval_jobs)))) as job:
+        for res_value in job.imap_unordered(_evaluate_circuit_with_timeout, eval_jobs, chunksize):
+            name = res_value.pop("name")
+            results[name] = res_value
+    return results
 
-        # generate qobj for original circuit
-        qobj_original = _compose_qobj("original", test_circuits,
-                                                      backend=backend,
-                                                      config=config,
-                                                      basis_gates=basis_gates,
-                                                      shots=1,
-                                                      seed=None)
-
-        # Compute original cost and check original coupling map
-        for circuit in qobj_original["circuits"]:
-            name = circuit["name"]
-            coupling_map = test_circuits[name].get("coupling_map", None)
-            coupling_map_passes = True
-            cost = 0
-            for op in circuit["compiled_circuit"]["operations"]:
-                cost += gate_costs.get(op["name"])  # compute cost
-                if op["name"] in ["cx", "CX"] \
-                        and coupling_map is not None:  # check coupling map
-                    coupling_map_passes &= (
-                        op["qubits"][0] in coupling_map)
-                    if op["qubits"][0] in coupling_map:
-                        coupling_map_passes &= (
-                            op["qubits"][1] in coupling_map[op["qubits"][0]]
-                        )
-            if verbose:
-                results[name]["cost_original"] = cost
-                results[name]["coupling_correct_original"] = coupling_map_passes
-
-        # Run simulation
-        time_start = time.process_time()
-        res_original = qp.run(qobj_original, timeout=GLOBAL_TIMEOUT)
-        results[name]["sim_time_orig"] = time.process_time() - time_start
-
-        # Generate qobj for optimized circuit
-        qobj_optimized = _compose_qobj("optimized", test_circuits,
-                                                      backend=backend,
-                                                      config=config,
-                                                      basis_gates=basis_gates,
-                                                      shots=1,
-                                                      seed=None)
-
-        # Compute compiled circuit cost and check coupling map
-        for circuit in qobj_optimized["circuits"]:
-            name = circuit["name"]
-            coupling_map = test_circuits[name].get("coupling_map", None)
-            coupling_map_passes = True
-            cost = 0
-            for op in circuit["compiled_circuit"]["operations"]:
-                cost += gate_costs.get(op["name"])  # compute cost
-                if op["name"] in ["cx", "CX"] \
-                        and coupling_map is not None:  # check coupling map
-                    coupling_map_passes &= (
-                        op["qubits"][0] in coupling_map)
-                    if op["qubits"][0] in coupling_map:
-                        coupling_map_passes &= (
-                            op["qubits"][1] in coupling_map[op["qubits"][0]]
-                        )
-            results[name]["cost_optimized"] = cost
-            results[name]["coupling_correct_optimized"] = coupling_map_passes
-
-        # Run simulation
-        time_start = time.process_time()
-        res_optimized = qp.run(qobj_optimized, timeout=GLOBAL_TIMEOUT)
-        results[name]["sim_time_opti"] = time.process_time() - time_start
-
-
-        if verbose:
-            # Generate qobj for reference circuit optimized by qiskit compiler
-            qobj_reference = _compose_qobj("reference", test_circuits,
-                                                      backend=backend,
-                                                      config=config,
-                                                      basis_gates=basis_gates,
-                                                      shots=1,
-                                                      seed=None)
-
-            # Compute reference cost and check reference coupling map
-            for circuit in qobj_reference["circuits"]:
-                name = circuit["name"]
-                coupling_map = test_circuits[name].get("coupling_map", None)
-                coupling_map_passes = True
-                cost = 0
-                for op in circuit["compiled_circuit"]["operations"]:
-                    cost += gate_costs.get(op["name"])  # compute cost
-                    if op["name"] in ["cx", "CX"] \
-                            and coupling_map is not None:  # check coupling map
-                        coupling_map_passes &= (
-                            op["qubits"][0] in coupling_map)
-                        if op["qubits"][0] in coupling_map:
-                            coupling_map_passes &= (
-                                op["qubits"][1] in coupling_map[op["qubits"][0]]
-                            )
-                results[name]["cost_reference"] = cost
-                results[name]["coupling_correct_reference"] = coupling_map_passes
-
-            # Skip simulation of reference State to speed things up!
-            # time_start = time.process_time()
-            # res_reference = qp.run(qobj_reference, timeout=GLOBAL_TIMEOUT)
-            # results[name]["sim_time_ref"] = time.process_time() - time_start
-
-
-        # Check output quantum state of optimized circuit is correct in comparison to original
-        for name in results.keys():
-            # handle errors here
-            data_original = res_original.get_data(name)
-            if test_circuits[name]["dag_optimized"]is not None:
-                data_optimized = res_optimized.get_data(name)
-                correct = _compare_outputs(data_original, data_optimized, test_circuits[name]["perm_optimized"])
-                results[name]["state_correct_optimized"] = correct
-            else:
-                results[name]["state_correct_optimized"] = False
-            # Skip verification of the reference State to speed things up!
-            # if verbose:
-            #     if test_circuits[name]["dag_reference"] is not None:
-            #         data_reference = res_reference.get_data(name)
-            #         correct = _compare_outputs(data_original, data_reference, test_circuits[name]["perm_reference"])
-            #         results[name]["state_correct_reference"] = correct
-            #     else:
-            #         results[name]["state_correct_reference"] = False
+
+def benchmark(compiler_function, test_circuits, repeats=5, warmup=1, processes=1, output=None):
+    """
+    Measures the run time of the given compiler_function without the noise of the evaluation.
+
+    Every circuit is compiled in a fresh worker process that is pinned to its own CPU, so the
+    measurements of different circuits do not share caches or compete for a core. After warmup
+    compilations that are not measured, the circuit is compiled repeats times.
+
+    Args:
+        compiler_function (function): reference to user compiler function
+        test_circuits (dict): named dict of circuits, in the form of evaluate
+        repeats (int): number of measured compilations of each circuit
+        warmup (int): number of compilations of each circuit before the measured ones
+        processes (int): number of circuits measured at the same time. Must not exceed the
+                         number of CPUs available to this process, else ValueError is raised
+        output (string): if given, the results are also written to this file as JSON
+
+    Returns:
+        dict
+        {
+            "name": circuit name
+            {
+                "wall_time": {"median": ..., "p95": ..., "min": ...} of the wall clock time,
+                "cpu_time": {"median": ..., "p95": ..., "min": ...} of the process time,
+                "peak_rss_kb": growth of the peak resident memory of the worker while it read
+                               and compiled the circuit, in kilobytes. The memory the worker
+                               shares with the process it was forked from is not included.
+                               None if the platform does not report it,
+                "cost": cost of the compiled circuit,
+                "cpu": the CPU the worker was pinned to, or None if pinning is not available
+            }
+        }
+        If the compilation of a circuit fails or its worker dies, its entry has the additional
+        key "error", with the traceback or the exit code of the worker, and None for the
+        measurements.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        free_cpus = sorted(os.sched_getaffinity(0))
+    else:
+        free_cpus = [None] * (os.cpu_count() or 1)
+    if processes > len(free_cpus):
+        raise ValueError("benchmark with %d processes on %d CPUs" % (processes, len(free_cpus)))
+    free_cpus = free_cpus[:processes]
+    bench_jobs = [[name, circuit["qasm"], circuit["coupling_map"], compiler_function, repeats,
+                   warmup] for name, circuit in test_circuits.items()]
+    results = {}
+    # The workers that are running, by the connection they send their result on. Every worker
+    # takes a free CPU and measures one circuit. Its CPU is free again when the worker is done,
+    # also if it died
+    running = {}
+    try:
+        while bench_jobs or running:
+            while bench_jobs and free_cpus:
+                cpu = free_cpus.pop(0)
+                bench_args = bench_jobs.pop(0)
+                receiver, sender = Pipe(duplex=False)
+                worker = Process(target=_benchmark_circuit, args=(sender, cpu, bench_args),
+                                 daemon=True)
+                worker.start()
+                sender.close()
+                running[receiver] = (worker, bench_args[0], cpu)
+            for receiver in wait(list(running)):
+                worker, name, cpu = running.pop(receiver)
+                try:
+                    res_value = receiver.recv()
+                except EOFError:
+                    # the worker died before it sent its result
+                    res_value = None
+                receiver.close()
+                worker.join()
+                free_cpus.append(cpu)
+                if res_value is None:
+                    res_value = _failed_benchmark(name, cpu, "worker died with exit code %s"
+                                                  % worker.exitcode)
+                    print("The benchmark worker of " + name + " died.")
+                results[res_value.pop("name")] = res_value
+    finally:
+        for worker, _, _ in running.values():
+            worker.terminate()
+    if output is not None:
+        with open(output, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
     return results
 
 
+def _benchmark_circuit(connection, cpu, bench_args):
+    """
+    Measure the compilation of a single circuit in a benchmark worker and send the result on
+    connection, see benchmark.
+
+    Args:
+        connection (Connection): the connection to send the result on
+        cpu (int): the CPU to pin the worker to, or None
+        bench_args (list): name, qasm, coupling_map, compiler_function, repeats and warmup
+    """
+    name, qasm, coupling_map, compiler_function, repeats, warmup = bench_args
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    # the peak of a forked worker starts at the memory of its parent
+    base_rss = None
+    if resource is not None:
+        base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        dag_original = qasm_to_dag_circuit(qasm, basis_gates=BASIS_GATES)
+        wall_times, cpu_times = [], []
+        for ii in range(warmup + repeats):
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            dag_compiled = compiler_function(dag_original, coupling_map=coupling_map,
+                                             gate_costs=GATE_COSTS)
+            if ii >= warmup:
+                wall_times.append(time.perf_counter() - wall_start)
+                cpu_times.append(time.process_time() - cpu_start)
+        peak_rss = None
+        if resource is not None:
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+            if sys.platform == "darwin":
+                peak_rss //= 1024  # bytes on macOS
+        operations = dag2json(dag_compiled, basis_gates=BASIS_GATES)["operations"]
+        cost, _ = _cost_and_coupling(operations, coupling_map, GATE_COSTS)
+        res_value = {"name": name,
+                     "wall_time": _time_statistics(wall_times),
+                     "cpu_time": _time_statistics(cpu_times),
+                     "peak_rss_kb": peak_rss,
+                     "cost": cost,
+                     "cpu": cpu}
+    except Exception:
+        err = traceback.format_exc()
+        print("An error occurred in the user compiler while benchmarking " + name + ".")
+        print(err)
+        res_value = _failed_benchmark(name, cpu, err)
+    connection.send(res_value)
+
+
+def _failed_benchmark(name, cpu, error):
+    """
+    The result of a circuit whose benchmark failed, with the keys of a successful one.
+
+    Args:
+        name (string): name of the circuit
+        cpu (int): the CPU of the worker, or None
+        error (string): the traceback or the exit code of the worker
+
+    Returns:
+        dict: the name and the results of the circuit, see benchmark
+    """
+    return {"name": name, "wall_time": None, "cpu_time": None, "peak_rss_kb": None,
+            "cost": None, "cpu": cpu, "error": error}
+    connection.close()
+
+
+def _time_statistics(times):
+    return {"median": float(np.median(times)), "p95": float(np.percentile(times, 95)),
+            "min": float(np.min(times))}
+
+
 def qasm_to_dag_circuit(qasm_string, basis_gates='u1,u2,u3,cx,id'):
     """
     Convert an OPENQASM text string to a DAGCircuit.
@@ -325,12 +369,167 @@ def qasm_to_dag_circuit(qasm_string, basis_gates='u1,u2,u3,cx,id'):
     Returns:
         A DAGCircuit object of the unrolled QASM circuit.
     """
+    # flat circuits that are already in the basis are read directly,
+    # everything else goes through the full parser and unroller
+    dag_circuit = _read_flat_qasm(qasm_string, basis_gates)
+    if dag_circuit is not None:
+        return dag_circuit
     program_node_circuit = qiskit.qasm.Qasm(data=qasm_string).parse()
     dag_circuit = Unroller(program_node_circuit,
                            DAGBackend(basis_gates.split(","))).execute()
     return dag_circuit
 
 
+# signatures (qubits, parameters) of the gates the fast reader understands
+FLAT_GATES = {"u1": (1, 1), "u2": (1, 2), "u3": (1, 3), "cx": (2, 0), "id": (1, 0)}
+FLAT_STATEMENT = re.compile(r"([a-z][a-zA-Z0-9_]*)\s*(?:\(([^()]*)\))?\s*(.*)$", re.S)
+FLAT_ARGUMENT = re.compile(r"\s*([a-z][a-zA-Z0-9_]*)\s*(?:\[\s*([0-9]+)\s*\])?\s*$")
+FLAT_NUMBER = re.compile(r"\s*([+-]?)\s*((?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?"
+                         r"|[0-9]+[eE][+-]?[0-9]+|[1-9][0-9]*|0|pi)\s*$")
+
+
+@lru_cache(maxsize=None)
+def _qelib1_gates():
+    """
+    Return the gate definitions of qelib1.inc, as the unroller records them.
+
+    Returns:
+        OrderedDict : gate name -> gate data
+    """
+    program = qiskit.qasm.Qasm(data='OPENQASM 2.0;\ninclude "qelib1.inc";\n').parse()
+    return Unroller(program, DAGBackend([])).execute().gates
+
+
+def _flat_parameter(sign, value):
+    """
+    Return the symbolic number the parser makes of a literal parameter,
+    without going through sympify's slow string parsing.
+
+    Args:
+        sign (str): "-", "+" or ""
+        value (str): the literal number or "pi"
+
+    Returns:
+        sympy.Expr : the parameter
+    """
+    if value == "pi":
+        number = sympy.pi
+    elif value.isdigit():
+        # the parser evaluates integers numerically, so 0 becomes Zero and
+        # every other integer a Float
+        number = sympy.N(int(value))
+    else:
+        number = sympy.Float(value)
+    return -number if sign == "-" else number
+
+
+def _read_flat_qasm(qasm_string, basis_gates):
+    """
+    Read a flat OPENQASM circuit directly into a DAGCircuit.
+
+    Only circuits that consist of register declarations, gates from
+    qelib1.inc which are already part of the basis, barriers and
+    measurements with literal parameters are understood. The result is
+    identical to the one of the full parser and unroller.
+
+    Args:
+        qasm_string (str): OPENQASM2.0 circuit string.
+        basis_gates (str): QASM gates to unroll circuit to.
+
+    Returns:
+        The DAGCircuit, or None if the circuit has to go through the
+        full parser.
+    """
+    basis = basis_gates.split(",")
+    statements = re.sub(r"//[^\n]*", "", qasm_string).split(";")
+    if statements[-1].strip() != "" or statements[0].split() != ["OPENQASM", "2.0"]:
+        return None
+    dag_circuit = DAGCircuit()
+    registers = {}
+    for statement in statements[1:-1]:
+        match = FLAT_STATEMENT.match(statement.strip())
+        if match is None:
+            return None
+        name, params, arguments = match.groups()
+        if name == "include":
+            if arguments.strip() != '"qelib1.inc"' or params is not None or dag_circuit.gates:
+                return None
+            for gate, data in _qelib1_gates().items():
+                dag_circuit.add_gate_data(gate, data)
+            continue
+        if params is not None:
+            params = [FLAT_NUMBER.match(param) for param in params.split(",")]
+            if None in params:
+                return None
+            params = [_flat_parameter(*param.groups()) for param in params]
+        else:
+            params = []
+        if name == "measure":
+            arguments = arguments.split("->")
+        else:
+            arguments = arguments.split(",")
+        arguments = [FLAT_ARGUMENT.match(argument) for argument in arguments]
+        if None in arguments:
+            return None
+        arguments = [argument.groups() for argument in arguments]
+        # register declarations
+        if name in ("qreg", "creg"):
+            if params or len(arguments) != 1 or arguments[0][1] is None:
+                return None
+            register, size = arguments[0][0], int(arguments[0][1])
+            if register in registers or size == 0:
+                return None
+            registers[register] = (name, size)
+            if name == "qreg":
+                dag_circuit.add_qreg(register, size)
+            else:
+                dag_circuit.add_creg(register, size)
+            continue
+        # resolve the arguments to lists of bits
+        bits = []
+        for register, index in arguments:
+            if register not in registers:
+                return None
+            kind, size = registers[register]
+            if index is None:
+                bits.append([(kind, (register, i)) for i in range(size)])
+            elif int(index) < size:
+                bits.append([(kind, (register, int(index)))])
+            else:
+                return None
+        if name == "barrier":
+            if params or any(kind != "qreg" for bit in bits for kind, _ in bit):
+                return None
+            qargs = [qubit for bit in bits for _, qubit in bit]
+            if len(set(qargs)) != len(qargs):
+                return None
+            if "barrier" not in dag_circuit.basis:
+                dag_circuit.add_basis_element("barrier", -1)
+            dag_circuit.apply_operation_back("barrier", qargs)
+        elif name == "measure":
+            if params or len(bits) != 2 or len(bits[0]) != len(bits[1]):
+                return None
+            if "measure" not in dag_circuit.basis:
+                dag_circuit.add_basis_element("measure", 1, 1)
+            for (qkind, qubit), (ckind, clbit) in zip(*bits):
+                if qkind != "qreg" or ckind != "creg":
+                    return None
+                dag_circuit.apply_operation_back("measure", [qubit], [clbit], [])
+        elif name in FLAT_GATES and name in basis and name in dag_circuit.gates:
+            if FLAT_GATES[name] != (len(bits), len(params)) or \
+                    any(len(bit) != 1 or bit[0][0] != "qreg" for bit in bits):
+                return None
+            qargs = [bit[0][1] for bit in bits]
+            if len(set(qargs)) != len(qargs):
+                return None
+            if name not in dag_circuit.basis:
+                dag_circuit.add_basis_element(name, len(qargs), 0, len(params))
+            dag_circuit.apply_operation_back(name, qargs, [], params)
+        else:
+            return None
+    return dag_circuit
+
+
 def get_layout(qubits = 5):
     # load a random layout for a specifed number or qubits
     # only layouts for 5, 16 and 20 qubits are stored
@@ -361,6 +560,9 @@ def load_coupling(name):
             "coupling_map" : actual coupling map as used by QISKit
             "position" : arrangement of the qubits in 2D if available
             "description": additional information on the coupling map
+            "edge_costs": cost of a cx on each edge, in the form of the
+                          coupling map with a dict {target: cost} for each
+                          control, if available
         }
 
     """
@@ -368,14 +570,193 @@ def load_coupling(name):
     with open("./layouts/"+name+".json", 'r') as infile:
         temp = json.load(infile)
         temp["coupling_map"] = {int(ii): kk for ii, kk in temp["coupling_map"].items()}
+        if "edge_costs" in temp:
+            temp["edge_costs"] = {int(ii): {int(jj): cost for jj, cost in kk.items()}
+                                  for ii, kk in temp["edge_costs"].items()}
         return temp
 
+class EvaluationTimeout(Exception):
+    """Raised in a worker when the evaluation of a circuit takes too long."""
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise EvaluationTimeout()
+
+
+def _evaluate_circuit_with_timeout(eval_args):
+    """
+    Evaluate a single circuit with a time limit, see _evaluate_circuit.
+
+    The limit is enforced by a single SIGALRM. The EvaluationTimeout it raises is passed on by
+    _compile_circuits, which otherwise records all errors of the compilers.
+
+    Args:
+        eval_args (list): the arguments of _evaluate_circuit followed by the timeout in seconds,
+                          or None for no limit
+
+    Returns:
+        dict: the name and the results of the circuit, as returned by evaluate
+    """
+    timeout = eval_args[-1]
+    if timeout is None or not hasattr(signal, "SIGALRM"):
+        return _evaluate_circuit(eval_args[:-1])
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return _evaluate_circuit(eval_args[:-1])
+    except EvaluationTimeout:
+        print("The evaluation of " + eval_args[0] + " took longer than " + str(timeout) + " s.")
+        res_values = {"name": eval_args[0], "optimizer_time": -1, "cost_optimized": None,
+                      "coupling_correct_optimized": False, "state_correct_optimized": False,
+                      "sim_time_orig": None, "sim_time_opti": None, "timed_out": True}
+        if eval_args[7]:
+            # verbose
+            res_values.update({"reference_time": -1, "cost_original": None,
+                               "cost_reference": None, "coupling_correct_original": False,
+                               "coupling_correct_reference": False})
+        return res_values
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _evaluate_circuit(eval_args):
+    """
+    Compile, simulate and verify a single circuit, see evaluate.
+
+    Args:
+        eval_args (list): name, qasm, coupling_map, compiler_function, gate_costs, basis_gates,
+                          backend, verbose, cache_dir and verifier of the circuit, see evaluate
+
+    Returns:
+        dict: the name and the results of the circuit, as returned by evaluate
+    """
+    name, qasm, coupling_map, compiler_function, gate_costs, basis_gates, backend, verbose, \
+        cache_dir, verifier = eval_args
+    circuit = {"dag_original": qasm_to_dag_circuit(qasm, basis_gates=basis_gates),
+               "coupling_map": coupling_map}
+    res_values = _compile_circuits([name, circuit, 0, compiler_function, gate_costs, cache_dir])
+    if verbose:
+        res_values.update(_compile_circuits([name, circuit, 1, _qiskit_compiler, gate_costs,
+                                             cache_dir]))
+    # determine the final permutation of the qubits
+    # this is done by analyzing the measurements on the qubits
+    res_values.update(_prep_sim([name, circuit, verbose]))
+    res_values.pop("circuit")
+
+    # Convert every circuit to json once, for the cost, the coupling check and the simulation
+    compiled_circuits = {}
+    for qobj_name in ["original", "optimized", "reference"] if verbose else ["original", "optimized"]:
+        if circuit["dag_" + qobj_name] is None:
+            # the compiler failed
+            res_values["cost_" + qobj_name] = None
+            res_values["coupling_correct_" + qobj_name] = False
+            continue
+        compiled_circuits[qobj_name] = dag2json(circuit["dag_" + qobj_name],
+                                                basis_gates=basis_gates)
+        # Compute the cost and check the coupling map
+        cost, coupling_map_passes = _cost_and_coupling(
+            compiled_circuits[qobj_name]["operations"], coupling_map, gate_costs)
+        if qobj_name != "original" or verbose:
+            res_values["cost_" + qobj_name] = cost
+            res_values["coupling_correct_" + qobj_name] = coupling_map_passes
+
+    if verifier == 'inverse':
+        if circuit["dag_optimized"] is not None:
+            correct, res_values["sim_time_orig"], res_values["sim_time_opti"] = \
+                _verify_by_inverse(circuit["dag_original"], circuit["dag_optimized"],
+                                   circuit["perm_optimized"])
+            res_values["state_correct_optimized"] = correct
+        else:
+            res_values["state_correct_optimized"] = False
+            res_values["sim_time_orig"] = res_values["sim_time_opti"] = None
+        return res_values
+
+    # Compose qobjs for simulation, the reference circuit is not simulated
+    config = {
+        'data': ['quantum_state'],
+    }
+    qobjs = {}
+    for qobj_name in compiled_circuits.keys() & {"original", "optimized"}:
+        qobjs[qobj_name] = _compose_qobj(qobj_name, name, compiled_circuits[qobj_name],
+                                         circuit["dag_" + qobj_name],
+                                         backend=backend,
+                                         config=config,
+                                         basis_gates=basis_gates,
+                                         shots=1,
+                                         seed=None)
+
+    # Run simulation
+    time_start = time.process_time()
+    res_original = _run_qobj(qobjs["original"])
+    res_values["sim_time_orig"] = time.process_time() - time_start
+    # Skip simulation of reference State to speed things up!
+
+    # Check output quantum state of optimized circuit is correct in comparison to original
+    if circuit["dag_optimized"] is not None:
+        time_start = time.process_time()
+        res_optimized = _run_qobj(qobjs["optimized"])
+        res_values["sim_time_opti"] = time.process_time() - time_start
+        data_original = res_original.get_data(name)
+        data_optimized = res_optimized.get_data(name)
+        correct = _compare_outputs(data_original, data_optimized, circuit["perm_optimized"])
+        res_values["state_correct_optimized"] = bool(correct)
+    else:
+        res_values["state_correct_optimized"] = False
+        res_values["sim_time_opti"] = None
+    return res_values
+
+
+def _run_qobj(qobj):
+    """
+    Run a qobj in this process. QuantumProgram.run hands the job to a pool of processes,
+    which the daemonic workers of evaluate cannot start.
+
+    Args:
+        qobj (dict): the qobj to run
+
+    Returns:
+        Result: the result of the simulation
+    """
+    q_job = QuantumJob(qobj, preformatted=True, resources={
+        'max_credits': qobj['config']['max_credits'], 'wait': 5, 'timeout': GLOBAL_TIMEOUT})
+    return run_backend(q_job)
+
+
+def _cost_and_coupling(operations, coupling_map, gate_costs):
+    """
+    Compute the cost of a circuit and check it against the coupling map.
+
+    Args:
+        operations (list): the operations of the circuit in the form of dag2json
+        coupling_map (dict): the coupling map, or None if all cnots are allowed
+        gate_costs (dict): the gate costs
+
+    Returns:
+        int, bool: the cost and whether all cnots satisfy the coupling map
+    """
+    coupling_map_passes = True
+    cost = 0
+    for op in operations:
+        cost += gate_costs.get(op["name"])  # compute cost
+        if op["name"] in ["cx", "CX"] \
+                and coupling_map is not None:  # check coupling map
+            coupling_map_passes &= (
+                op["qubits"][0] in coupling_map)
+            if op["qubits"][0] in coupling_map:
+                coupling_map_passes &= (
+                    op["qubits"][1] in coupling_map[op["qubits"][0]]
+                )
+    return cost, coupling_map_passes
+
+
 def _compile_circuits(compile_args):
     name = compile_args[0]
     circuit = compile_args[1]
     comp_type = compile_args[2]
     compiler_function = compile_args[3]
     gate_costs = compile_args[4]
+    cache_dir = compile_args[5]
     res_values = {}
     res_values["name"] = name
     # initialize error
@@ -383,11 +764,10 @@ def _compile_circuits(compile_args):
     if comp_type == 0:
         # Evaluate runtime of submitted compiler_function
         try:
-            time_start = time.process_time()
-            circuit["dag_optimized"] = compiler_function(
-                circuit["dag_original"], coupling_map=circuit["coupling_map"],
-                gate_costs=gate_costs)
-            res_values["optimizer_time"] = time.process_time() - time_start
+            circuit["dag_optimized"], res_values["optimizer_time"] = _cached_compile(
+                compiler_function, circuit, gate_costs, cache_dir)
+        except EvaluationTimeout:
+            raise
         except:
             circuit["dag_optimized"] = None
             err = traceback.format_exc()
@@ -401,11 +781,10 @@ def _compile_circuits(compile_args):
     else:
         # Evaluate runtime of qiskit compiler
         try:
-            time_start = time.process_time()
-            circuit["dag_reference"] = _qiskit_compiler(
-                circuit["dag_original"], coupling_map=circuit["coupling_map"],
-                gate_costs=gate_costs)
-            res_values["reference_time"] = time.process_time() - time_start
+            circuit["dag_reference"], res_values["reference_time"] = _cached_compile(
+                _qiskit_compiler, circuit, gate_costs, cache_dir)
+        except EvaluationTimeout:
+            raise
         except:
             circuit["dag_reference"] = None
             err = traceback.format_exc()
@@ -420,6 +799,55 @@ def _compile_circuits(compile_args):
 
     return res_values
 
+@lru_cache(maxsize=None)
+def _result_cache(cache_dir):
+    """
+    Return the cache of a directory, one per process so that it keeps track of
+    the size of the directory.
+
+    Args:
+        cache_dir (string): directory of the cache
+
+    Returns:
+        ResultCache : the cache
+    """
+    return ResultCache(cache_dir)
+
+
+def _cached_compile(compiler_function, circuit, gate_costs, cache_dir):
+    """
+    Compile a circuit, or read the result from the cache.
+
+    Args:
+        compiler_function (function): the compiler
+        circuit (dict): the circuit with its "dag_original" and "coupling_map"
+        gate_costs (dict): the gate costs
+        cache_dir (string): directory of the cache, or None to always compile
+
+    Returns:
+        DAGCircuit, float: the compiled circuit and the process time of its compilation
+    """
+    cache = None
+    fingerprint = code_fingerprint(compiler_function) if cache_dir is not None else None
+    # compilers without a fingerprint, e.g. bound methods or closures over
+    # arbitrary objects, are always compiled
+    if fingerprint is not None:
+        cache = _result_cache(cache_dir)
+        key = cache.key(circuit["dag_original"], circuit["coupling_map"],
+                        {"compiler": fingerprint, "gate_costs": gate_costs})
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    time_start = time.process_time()
+    dag_compiled = compiler_function(
+        circuit["dag_original"], coupling_map=circuit["coupling_map"],
+        gate_costs=gate_costs)
+    compile_time = time.process_time() - time_start
+    if cache is not None:
+        cache.put(key, dag_compiled, compile_time)
+    return dag_compiled, compile_time
+
+
 def _prep_sim(sim_args):
     name = sim_args[0]
     circuit = sim_args[1]
@@ -479,15 +907,13 @@ def _qiskit_compiler(dag_circuit, coupling_map=None, gate_costs=None):
 
 def _get_perm(perm):
     # get the permutation indices for the compiled quantum state given the permutation
+    # bit ii of the permuted index is bit perm[ii] of the original index
     n = len(perm)
-    res = np.arange(2**n)
-    for num_ind in range(2**n):
-        ss_orig = [digit for digit in bin(num_ind)[2:].zfill(n)]
-        ss_final = ss_orig.copy()
-        for ii in range(n):
-            ss_final[n-1-ii] = ss_orig[n-1-perm[ii]]
-        res[num_ind] = int(''.join(ss_final),2)
-    return list(res)
+    indices = np.arange(2**n)
+    res = np.zeros(2**n, dtype=indices.dtype)
+    for ii in range(n):
+        res |= ((indices >> perm[ii]) & 1) << ii
+    return res
 
 def _compare_outputs(data_original, data_compiled, permutation, threshold=ERROR_LIMIT):
     # compare the output states of the original and the compiled circuit
@@ -508,39 +934,175 @@ def _compare_outputs(data_original, data_compiled, permutation, threshold=ERROR_
     return abs(fidelity - 1.0) < threshold
 
 
-def _compose_qobj(qobj_name, test_circuits,
-                   backend="local_qasm_simulator",
-                   config=None,
-                   basis_gates='u1,u2,u3,id,cx',
-                   shots=1,
-                   max_credits=3,
-                   seed=None):
-    qobj_out = {"id": qobj_name+"_test_circuits",
-                     "config": config,
-                     "circuits": []}
-
-    qobj_out["config"] = {"max_credits": max_credits,
-                               "backend": backend,
-                               "seed": seed,
-                               "shots": shots}
-
-    for name, circuit in test_circuits.items():
-        # only add the job if there was no error in generating the circuit
-        if circuit["dag_"+qobj_name] is not None:
-            job = {}
-            job["name"] = name
-            # config parameters used by the runner
-            if config is None:
-                config = {}  # default to empty config dict
-            job["config"] = copy.deepcopy(config)
-            job["config"]["basis_gates"] = basis_gates
-            job["config"]["seed"] = seed
-
-            # Add circuit
-            dag_circuit = copy.deepcopy(circuit["dag_"+qobj_name])
-            job["compiled_circuit"] = dag2json(dag_circuit,
-                                               basis_gates=basis_gates)
-            job["compiled_circuit_qasm"] = dag_circuit.qasm(qeflag=True)
-            qobj_out["circuits"].append(copy.deepcopy(job))
+def _verify_by_inverse(dag_original, dag_compiled, permutation, threshold=ERROR_LIMIT,
+                       inputs=INVERSE_INPUTS, seed=0):
+    """
+    Check that the compiled circuit produces the state of the original circuit, without
+    comparing two state vectors. The original circuit is simulated on an input state, with
+    qubit ii placed on the physical qubit that is measured into classical bit ii, and then the
+    compiled circuit is undone gate by gate on the same state vector. The result must be the
+    input state again, up to a global phase. Only the state vector and a scratch buffer of the
+    same size are allocated.
+
+    The compiled circuit does not record its initial layout, so only inputs that are the same
+    for every placement of the qubits can be used. These are the all zero state and, if every
+    physical qubit holds a qubit of the original circuit, products of the same random single
+    qubit state on all qubits. A random product state also catches errors in the phases, which
+    the all zero state misses.
+
+    Both circuits must not contain measurements anymore, see _prep_sim.
 
+    Args:
+        dag_original (DAGCircuit): the original circuit
+        dag_compiled (DAGCircuit): the compiled circuit
+        permutation (list): the classical bit each physical qubit was measured into
+        threshold (float): the allowed deviation of the fidelity from one
+        inputs (int): the number of random product states checked besides the all zero state
+        seed (int): the seed of the random product states
+
+    Returns:
+        bool, float, float: whether the compiled circuit is correct, and the process time spent
+                            on the original and on the compiled circuit. Circuits with gates
+                            that cannot be simulated here are not correct
+    """
+    n = len(dag_compiled.get_qubits())
+    # The physical qubit that holds each qubit of the original circuit
+    location = {bit: qubit for qubit, bit in enumerate(permutation)}
+    if any(qubit[1] not in location for qubit in dag_original.get_qubits()):
+        return False, 0.0, 0.0
+    # The single qubit gates preparing the input states from the all zero state
+    preparations = [None]
+    if len(dag_original.get_qubits()) == n:
+        rng = np.random.RandomState(seed)
+        preparations += [{"name": "u3", "params": list(rng.uniform(0, 2 * np.pi, 3))}
+                         for _ in range(inputs)]
+    original, compiled = _op_nodes(dag_original), _op_nodes(dag_compiled)[::-1]
+    state = np.empty(2**n, dtype=complex)
+    scratch = np.empty(2**n, dtype=complex)
+    time_original, time_compiled = 0.0, 0.0
+    try:
+        for preparation in preparations:
+            time_start = time.process_time()
+            state[:] = 0
+            state[0] = 1
+            if preparation is not None:
+                for qubit in range(n):
+                    _apply_gate(state, scratch, n, preparation, [qubit], inverse=False)
+            for nd in original:
+                _apply_gate(state, scratch, n, nd, [location[q[1]] for q in nd["qargs"]],
+                            inverse=False)
+            time_original += time.process_time() - time_start
+            time_start = time.process_time()
+            for nd in compiled:
+                _apply_gate(state, scratch, n, nd, [q[1] for q in nd["qargs"]], inverse=True)
+            if preparation is not None:
+                for qubit in range(n):
+                    _apply_gate(state, scratch, n, preparation, [qubit], inverse=True)
+            time_compiled += time.process_time() - time_start
+            if not abs(abs(state[0])**2 - 1.0) < threshold:
+                return False, time_original, time_compiled
+    except ValueError:
+        # a gate _apply_gate cannot simulate
+        return False, time_original, time_compiled
+    return True, time_original, time_compiled
+
+
+def _op_nodes(dag_circuit):
+    # the operation nodes of the circuit in topological order
+    graph = dag_circuit.multi_graph
+    return [graph.node[n] for n in nx.topological_sort(graph) if graph.node[n]["type"] == "op"]
+
+
+def _apply_gate(state, scratch, n, nd, qubits, inverse):
+    """
+    Apply a gate to the state vector in place, see _verify_by_inverse.
+
+    Args:
+        state (ndarray): the state vector, qubit ii is bit ii of the index
+        scratch (ndarray): a buffer of the size of state
+        n (int): the number of qubits
+        nd (dict): the node of the gate
+        qubits (list): the qubits of state the gate acts on
+        inverse (bool): apply the inverse of the gate
+    """
+    name = nd["name"]
+    if name in ["barrier", "id"]:
+        return
+    if name in ["cx", "CX"]:
+        # exchange the amplitudes with the control set that differ in the target
+        control, target = qubits
+        tensor = state.reshape((2,) * n)
+        ones = [slice(None)] * n
+        ones[n - 1 - control] = 1
+        ones[n - 1 - target] = 1
+        zeros = list(ones)
+        zeros[n - 1 - target] = 0
+        ones, zeros = tuple(ones), tuple(zeros)
+        buffer = scratch[:2**(n - 2)].reshape(tensor[ones].shape)
+        np.copyto(buffer, tensor[ones])
+        tensor[ones] = tensor[zeros]
+        tensor[zeros] = buffer
+        return
+    params = [float(p) for p in nd["params"]]
+    if name == "u1":
+        theta, phi, lam = 0.0, 0.0, params[0]
+    elif name == "u2":
+        theta, phi, lam = np.pi / 2, params[0], params[1]
+    elif name in ["u3", "U"]:
+        theta, phi, lam = params
+    else:
+        raise ValueError("gate %s cannot be verified" % name)
+    matrix = np.array([[np.cos(theta / 2), -np.exp(1j * lam) * np.sin(theta / 2)],
+                       [np.exp(1j * phi) * np.sin(theta / 2), np.exp(1j * (phi + lam)) * np.cos(theta / 2)]])
+    if inverse:
+        matrix = matrix.conj().T
+    qubit = qubits[0]
+    pairs = state.reshape(2**(n - 1 - qubit), 2, 2**qubit)
+    zero, one = pairs[:, 0, :], pairs[:, 1, :]
+    new_zero = scratch[:2**(n - 1)].reshape(zero.shape)
+    product = scratch[2**(n - 1):].reshape(zero.shape)
+    np.multiply(zero, matrix[0, 0], out=new_zero)
+    np.multiply(one, matrix[0, 1], out=product)
+    new_zero += product
+    np.multiply(zero, matrix[1, 0], out=product)
+    one *= matrix[1, 1]
+    one += product
+    zero[...] = new_zero
+
+
+def _compose_qobj(qobj_name, name, compiled_circuit, dag_circuit,
+                  backend="local_qasm_simulator",
+                  config=None,
+                  basis_gates='u1,u2,u3,id,cx',
+                  shots=1,
+                  max_credits=3,
+                  seed=None):
+    """
+    Compose the qobj that simulates a single circuit.
+
+    Args:
+        qobj_name (str): the kind of the circuit, "original", "optimized" or "reference"
+        name (str): the name of the circuit
+        compiled_circuit (dict): the circuit in the form of dag2json
+        dag_circuit (DAGCircuit): the same circuit, for the QASM of the qobj
+
+    Returns:
+        dict: the qobj
+    """
+    qobj_out = {"id": qobj_name+"_test_circuits",
+                "config": {"max_credits": max_credits,
+                           "backend": backend,
+                           "seed": seed,
+                           "shots": shots},
+                "circuits": []}
+    job = {}
+    job["name"] = name
+    # config parameters used by the runner
+    job["config"] = copy.deepcopy(config) if config is not None else {}
+    job["config"]["basis_gates"] = basis_gates
+    job["config"]["seed"] = seed
+    # Add circuit. dag2json and qasm do not modify the circuit, so it is not copied
+    job["compiled_circuit"] = compiled_circuit
+    job["compiled_circuit_qasm"] = dag_circuit.qasm(qeflag=True)
+    qobj_out["circuits"].append(job)
     return qobj_out
@@ -35,11 +35,20 @@ Description of the algorithm :
 
 # Include any Python modules needed for your implementation here
 
-from copy import deepcopy
-import random
-from qiskit.qasm import Qasm
+from collections import OrderedDict
+from functools import lru_cache
+from multiprocessing import Pipe, Pool, Process
+import heapq
+import math
+import os
+import re
+import time
+import numpy as np
+import networkx as nx
+import sympy
 from qiskit.mapper import direction_mapper, cx_cancellation, optimize_1q_gates, Coupling
-from qiskit import qasm, unroll
+from qiskit.mapper._mappererror import MapperError
+from result_cache import ResultCache, code_fingerprint
 
 
 # The following class is the input and output circuit representation for a
@@ -47,9 +56,67 @@ from qiskit import qasm, unroll
 from qiskit.dagcircuit import DAGCircuit
 
 WIDTH = 4
-DEPTH = 4
+DEPTH = 2
+# Maximum depth the tree may grow to, if the mapper runs with a budget and
+# is ahead of schedule
+MAX_DEPTH = DEPTH + 2
+# Number of coupling maps whose precomputed data is kept in memory
+DEVICE_CACHE_SIZE = 16
+# Maximum number of states remembered by the transposition table
+TABLE_SIZE = 1 << 16
+# Number of leaves the parallel search expands with one seed, see
+# parallel_update_tree
+SEED_LEAVES = 8
+# The parallel search expands the leaves in the main process if there are
+# fewer than this many groups of SEED_LEAVES leaves per worker, since
+# sending them costs more than it saves then, see SearchProcesses.expand
+MIN_WORKER_GROUPS = 2
+# Number of cnots on each qubit after the front layer that are included in
+# the score of a leaf, and the factor by which the weight of each further
+# cnot decays
+LOOKAHEAD = 2
+LOOKAHEAD_DECAY = 0.5
+# Gate costs used if compiler_function gets none, the same as the ones of
+# the evaluation
+DEFAULT_GATE_COSTS = {'id': 0, 'u1': 0, 'measure': 0, 'reset': 0, 'barrier': 0,
+                      'u2': 1, 'u3': 1, 'U': 1, 'cx': 10, 'CX': 10}
+# Whether the tree search may execute cnots at distance two by a bridge. It
+# is off by default, since on the random circuits the compiled circuits cost
+# about 5% more with bridges than with swaps only
+BRIDGES = False
+# Number of partial solutions kept by the beam search engine
+BEAM_WIDTH = 32
+# Number of gates that are not executed yet that stream_swap_mapper keeps in
+# memory
+WINDOW = 1000
+# Number of parameters and qubits of the gates read_qasm_operations knows,
+# the builtin ones and those of qelib1.inc
+QASM_GATES = {"U": (3, 1), "CX": (0, 2), "measure": (0, 1), "reset": (0, 1),
+              "u3": (3, 1), "u2": (2, 1), "u1": (1, 1), "cx": (0, 2), "id": (0, 1),
+              "x": (0, 1), "y": (0, 1), "z": (0, 1), "h": (0, 1), "s": (0, 1), "sdg": (0, 1),
+              "t": (0, 1), "tdg": (0, 1), "rx": (1, 1), "ry": (1, 1), "rz": (1, 1),
+              "cz": (0, 2), "cy": (0, 2), "ch": (0, 2), "ccx": (0, 3), "crz": (1, 2),
+              "cu1": (1, 2), "cu3": (3, 2)}
+# The tokens of the parameters of QASM operations: numbers, pi, operators and
+# parentheses, each after optional whitespace
+QASM_TOKEN = re.compile(r"\s*((?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?|pi|[-+*/()])")
+# Number of forward passes of the reverse pass placement, if it has no time
+# budget
+LAYOUT_PASSES = 3
+# Fraction of the time budget of the compiler used by the placement, if no
+# placement time is given
+PLACEMENT_SHARE = 0.25
+# Depth of the search tree used in the passes of the placement
+LAYOUT_DEPTH = 2
+# Seed of the random tie breaking of the search, if none is given
+SEED = 123
+# Tolerance below which merge_1q_gates treats an angle as zero
+ANGLE_TOLERANCE = 1e-9
 
-def compiler_function(dag_circuit, coupling_map=None, gate_costs=None):
+def compiler_function(dag_circuit, coupling_map=None, gate_costs=None, processes=None,
+                      time_budget=None, node_budget=None, placement="reverse",
+                      placement_time=None, engine="tree", beam_width=BEAM_WIDTH,
+                      edge_costs=None, cache_dir=None, seed=SEED, trials=1, bridges=BRIDGES):
     """
     Modify a DAGCircuit based on a gate cost function.
 
@@ -68,402 +135,2352 @@ def compiler_function(dag_circuit, coupling_map=None, gate_costs=None):
                                  A coupling map of None corresponds an
                                  all-to-all connected topology.
         gate_costs (dict) : dictionary of gate names and costs.
+        processes (int) : If given, the swap search is run in parallel by
+                          up to this many worker processes, see
+                          my_swap_mapper and SearchProcesses.
+        time_budget (float) : If given, the compilation adapts its effort to
+                              finish within about this many seconds. The
+                              placement and the swap search get what is left
+                              of them, counted from the start. The single
+                              qubit gates are then merged by merge_1q_gates
+                              instead of optimize_1q_gates of QISKit, which
+                              cannot be interrupted. The other final passes
+                              are fast but not included.
+        node_budget (int) : If given, the swap search adapts its effort to
+                            create at most about this many tree nodes.
+        placement (str) : Method choosing the initial layout, one of the keys
+                          of PLACEMENTS.
+        placement_time (float) : If given, the placement stops improving the
+                                 initial layout after this many seconds.
+                                 If None and time_budget is given, the
+                                 placement gets PLACEMENT_SHARE of the time
+                                 left of the budget.
+        engine (str) : Search used to find the swaps, "tree" or "beam", see
+                       my_swap_mapper.
+        beam_width (int) : Number of partial solutions kept by the beam
+                           search.
+        edge_costs (dict) : Cost of a cnot on each edge of the coupling, in
+                            the form of the coupling map but with a
+                            dictionary {target: cost} for every control.
+                            Edges that are not given cost gate_costs["cx"].
+        cache_dir (str) : If given, the compiled circuits are cached in this
+                          directory, see result_cache.ResultCache. A circuit
+                          that was compiled before with the same coupling
+                          map and settings is not compiled again.
+        seed (int) : Seed of the random tie breaking of the search. The
+                     same seed gives the same circuit for any number of
+                     processes. The parallel search and the search in a
+                     single process give different circuits, though.
+        trials (int) : Number of searches with the seeds seed, seed + 1, ...
+                       The cheapest circuit is returned. If processes is
+                       given, the searches run in parallel, each in a single
+                       process. Trials that would start after the time
+                       budget is used up are skipped.
+        bridges (bool) : If true, the tree search may execute cnots at
+                         distance two by a bridge instead of a swap, see
+                         choose_bridge.
 
     Returns:
         A modified DAGCircuit object that satisfies an input coupling_map
         and has as low a gate_cost as possible.
     """
-    # I only modified the swap mapper
-
-    coupling = Coupling(coupling_map)
-    # Add swaps, so that we only use cnots that are allowed by the coupling map
-    compiled_dag = my_swap_mapper(deepcopy(dag_circuit), coupling, speedup = False)
-    # Expand swaps
-    basis_gates = "u1,u2,u3,cx,id"  # QE target basis
-    program_node_circuit = qasm.Qasm(data=compiled_dag.qasm()).parse()
-    unroller_circuit = unroll.Unroller(program_node_circuit,
-                                       unroll.DAGBackend(
-                                           basis_gates.split(",")))
-    compiled_dag = unroller_circuit.execute()
-    # Change cx directions
-    compiled_dag = direction_mapper(compiled_dag, coupling)
-    # Simplify cx gates
-    cx_cancellation(compiled_dag)
-    # Simplify single qubit gates
-    compiled_dag = optimize_1q_gates(compiled_dag)
-
-    # Return the compiled dag circuit
-    return compiled_dag
+    compiler = Compiler(coupling_map, gate_costs, edge_costs, processes = processes,
+                        time_budget = time_budget, node_budget = node_budget,
+                        placement = placement, placement_time = placement_time,
+                        engine = engine, beam_width = beam_width, cache_dir = cache_dir,
+                        seed = seed, trials = trials, bridges = bridges)
+    return compiler.compile(dag_circuit)
 
+class Compiler:
+    """
+    Compiles circuits for one coupling map. The data of the coupling is
+    computed once when the compiler is created, so compiling many circuits
+    for the same device does not repeat it.
 
-def my_swap_mapper(circuit_graph, coupling, speedup = False, initial_layout = None):
-    """ TODO: add description"""
-    gates = read_gates(circuit_graph)
-    qubits = coupling.get_qubits()
-    if initial_layout == None:
-        # We start with a trivial layout, no significat improvement, especially
-        # for large circuits, could be achived by optimizing the initial layout
-        initial_layout = {qubit : qubit for qubit in qubits}
-    qasm_string = ""
+    Attributes:
+        coupling_map(dict) : coupling map for device topology
+        coupling(Coupling) : the coupling map as needed by the direction
+                             mapper
+        gate_costs(dict)   : costs of the gates
+        edge_costs(dict)   : costs of the cnots on each edge, or None
+        options(dict)      : the options of the swap search, see
+                             compiler_function
+        cache(ResultCache) : cache of the compiled circuits, or None
+    """
+
+    def __init__(self, coupling_map, gate_costs = None, edge_costs = None, processes = None,
+                 time_budget = None, node_budget = None, placement = "reverse",
+                 placement_time = None, engine = "tree", beam_width = BEAM_WIDTH,
+                 cache_dir = None, seed = SEED, trials = 1, bridges = BRIDGES):
+        """
+        Args:
+            coupling_map, gate_costs, edge_costs and the options: see
+            compiler_function
+        """
+        if placement not in PLACEMENTS:
+            raise MapperError("unknown placement %s" % placement)
+        self.coupling_map = coupling_map
+        self.coupling = Coupling(coupling_map)
+        self.gate_costs = gate_costs
+        self.edge_costs = edge_costs
+        self.options = {"processes": processes, "time_budget": time_budget,
+                        "node_budget": node_budget, "placement": placement,
+                        "placement_time": placement_time, "engine": engine,
+                        "beam_width": beam_width, "seed": seed, "trials": trials,
+                        "bridges": bridges}
+        self.cache = None
+        if cache_dir != None:
+            self.cache = ResultCache(cache_dir)
+        # Fill the cache of the device data
+        get_device(coupling_map, gate_costs, edge_costs)
+
+    def compile(self, dag_circuit):
+        """ Compiles one circuit, see compiler_function"""
+        # All stages of the compilation share the time budget. The deadline
+        # is also compared in the worker processes of the trials, so it is
+        # taken from a clock that is the same for all processes
+        deadline = None
+        if self.options["time_budget"] != None:
+            deadline = time.monotonic() + self.options["time_budget"]
+        if self.cache == None:
+            return self._compile(dag_circuit, deadline)
+        # With several trials, every trial searches in a single process, so
+        # the number of processes does not change the result. With one
+        # trial, the parallel search seeds every group of leaves on its own,
+        # so it gives other circuits than the search in a single process.
+        # Its result does not depend on the number of processes, though
+        settings = {name: value for name, value in self.options.items() if name != "processes"}
+        settings["parallel_search"] = (self.options["processes"] != None
+                                       and self.options["trials"] == 1)
+        settings["gate_costs"] = self.gate_costs
+        settings["edge_costs"] = self.edge_costs
+        settings["code"] = code_fingerprint(Compiler)
+        key = self.cache.key(dag_circuit, self.coupling_map, settings)
+        entry = self.cache.get(key)
+        if entry != None:
+            return entry[0]
+        start = time.process_time()
+        compiled_dag = self._compile(dag_circuit, deadline)
+        self.cache.put(key, compiled_dag, time.process_time() - start)
+        return compiled_dag
+
+    def _compile(self, dag_circuit, deadline = None):
+        """ Compiles one circuit without looking at the cache. With several
+            trials, the cheapest of their circuits is returned. deadline is
+            the value of time.monotonic() at which the time budget ends, or
+            None"""
+        options = self.options
+        seeds = [options["seed"] + i for i in range(options["trials"])]
+        if len(seeds) == 1:
+            return self._compile_seed(dag_circuit, seeds[0], deadline)
+        if options["processes"] == None:
+            compiled_dags = []
+            for seed in seeds:
+                if compiled_dags and deadline != None and time.monotonic() >= deadline:
+                    break
+                compiled_dags.append(self._compile_seed(dag_circuit, seed, deadline))
+        else:
+            with Pool(min(options["processes"], len(seeds)), initializer=_init_compiler,
+                      initargs=(self,)) as pool:
+                compiled_dags = pool.map(_compile_seed_in_worker,
+                                         [(dag_circuit, seed, deadline) for seed in seeds])
+            compiled_dags = [dag for dag in compiled_dags if dag != None]
+        # The first of the cheapest circuits, so that the result does not
+        # depend on the order the workers finish in
+        return min(compiled_dags, key=lambda dag: circuit_cost(dag, self.gate_costs,
+                                                              self.edge_costs))
+
+    def _compile_seed(self, dag_circuit, seed, deadline = None):
+        """ Compiles one circuit with the given seed of the search. The
+            placement and the swap search get the time left until deadline,
+            see _compile. With a deadline, the single qubit gates are
+            merged by merge_1q_gates"""
+        options = self.options
+        # Add swaps, so that we only use cnots that are allowed by the coupling map.
+        # The swaps are already expanded into cnots. The mapper does not modify
+        # dag_circuit, so it does not need to be copied
+        placement_time = options["placement_time"]
+        if deadline != None:
+            left = max(deadline - time.monotonic(), 0)
+            if placement_time == None:
+                placement_time = PLACEMENT_SHARE * left
+            else:
+                placement_time = min(placement_time, left)
+        initial_layout = choose_initial_layout(dag_circuit, self.coupling_map, options["placement"],
+                                               placement_time, self.gate_costs, self.edge_costs,
+                                               seed)
+        budget = None
+        if deadline != None or options["node_budget"] != None:
+            time_budget = None
+            if deadline != None:
+                time_budget = max(deadline - time.monotonic(), 0)
+            budget = Budget(time_budget, options["node_budget"])
+        compiled_dag = my_swap_mapper(dag_circuit, self.coupling_map, speedup = False,
+                                      initial_layout = initial_layout,
+                                      processes = options["processes"], budget = budget,
+                                      engine = options["engine"],
+                                      beam_width = options["beam_width"],
+                                      bridges = options["bridges"],
+                                      gate_costs = self.gate_costs, edge_costs = self.edge_costs,
+                                      seed = seed)
+        # Change cx directions
+        compiled_dag = direction_mapper(compiled_dag, self.coupling)
+        # Simplify cx gates
+        cx_cancellation(compiled_dag)
+        # Simplify single qubit gates. The symbolic optimize_1q_gates cannot
+        # be interrupted and may take much longer than the search, so with a
+        # time budget the gates are merged numerically instead
+        if deadline != None:
+            compiled_dag = merge_1q_gates(compiled_dag)
+        else:
+            compiled_dag = optimize_1q_gates(compiled_dag)
+
+        # Return the compiled dag circuit
+        return compiled_dag
+
+    def compile_many(self, dag_circuits, processes = None, chunksize = 1):
+        """
+        Compiles many circuits. The compiled circuits are yielded one by one
+        in the order of dag_circuits, so they do not all have to be kept in
+        memory.
+
+        Args:
+            dag_circuits(iterable) : the circuits to compile
+            processes(int)         : If given, the circuits are compiled by a
+                                     pool of this many processes. The swap
+                                     search then runs in a single process in
+                                     each of them
+            chunksize(int)         : number of circuits sent to a worker at
+                                     once
+
+        Returns:
+            A generator of the compiled circuits
+        """
+        if processes == None:
+            for dag_circuit in dag_circuits:
+                yield self.compile(dag_circuit)
+            return
+        pool = Pool(processes, initializer=_init_compiler, initargs=(self,))
+        try:
+            for compiled_dag in pool.imap(_compile_in_worker, dag_circuits, chunksize):
+                yield compiled_dag
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+# The compiler of a worker process of Compiler.compile_many
+_compiler = {}
+
+def _init_compiler(compiler):
+    """ Stores the compiler of a worker process. The workers of a pool cannot
+        start processes of their own, so the swap search runs in the worker"""
+    compiler.options["processes"] = None
+    _compiler["compiler"] = compiler
+
+def _compile_in_worker(dag_circuit):
+    """ Compiles a circuit in a worker process, see Compiler.compile_many"""
+    return _compiler["compiler"].compile(dag_circuit)
+
+def _compile_seed_in_worker(task):
+    """ Compiles a circuit with one seed in a worker process, see
+        Compiler._compile. Returns None if the trial would start after the
+        deadline, except for the first seed"""
+    dag_circuit, seed, deadline = task
+    compiler = _compiler["compiler"]
+    if seed != compiler.options["seed"] and deadline != None and time.monotonic() >= deadline:
+        return None
+    return compiler._compile_seed(dag_circuit, seed, deadline)
+
+def circuit_cost(dag_circuit, gate_costs = None, edge_costs = None):
+    """
+    Computes the cost of a circuit.
+
+    Args:
+        dag_circuit(DAGCircuit) : the circuit
+        gate_costs(dict)        : costs of the gates, DEFAULT_GATE_COSTS if
+                                  None. Gates without a cost are free
+        edge_costs(dict)        : costs of the cnots on each edge, see
+                                  compiler_function. The qubits of the
+                                  circuit are the qubits of the coupling
+
+    Returns:
+        The sum of the costs of all gates
+    """
+    if gate_costs == None:
+        gate_costs = DEFAULT_GATE_COSTS
+    cost = 0
+    for _, nd in dag_circuit.multi_graph.nodes(data=True):
+        if nd["type"] != "op":
+            continue
+        name = nd["name"]
+        if name in ("cx", "CX") and edge_costs != None:
+            (_, control), (_, target) = nd["qargs"]
+            cost += edge_costs.get(control, {}).get(target, gate_costs.get(name, 0))
+        else:
+            cost += gate_costs.get(name, 0)
+    return cost
+
+
+def merge_1q_gates(circuit):
+    """
+    Merges every run of single qubit gates into one u1, u2 or u3 gate, or
+    removes it if it is the identity up to a global phase, like
+    optimize_1q_gates of QISKit. The gates are multiplied as matrices
+    instead of composing their parameters symbolically, which takes far
+    longer than the search on large circuits. The h gates of
+    direction_mapper are replaced by u2 gates.
+
+    Args:
+        circuit(DAGCircuit) : the circuit in the basis u1, u2, u3, cx, id,
+                              and h. Modified in place
+
+    Returns:
+        circuit
+    """
+    graph = circuit.multi_graph
+    runs = circuit.collect_runs(["u1", "u2", "u3", "id", "h"])
+    in_runs = {n for run in runs for n in run}
+    runs = list(runs) + [(n,) for n, nd in graph.nodes(data=True)
+                         if nd["type"] == "op" and nd["name"] == "h" and n not in in_runs]
+    if runs and "u2" not in circuit.basis:
+        circuit.add_basis_element("u2", 1, 0, 2)
+    for run in runs:
+        matrix = np.eye(2, dtype=complex)
+        for n in run:
+            matrix = _gate_matrix(graph.node[n]["name"], graph.node[n]["params"]).dot(matrix)
+        name, params = _matrix_gate(matrix)
+        if name == None:
+            for n in run:
+                circuit._remove_op_node(n)
+            continue
+        if name not in circuit.basis:
+            circuit.add_basis_element(name, 1, 0, len(params))
+        nx.set_node_attributes(graph, name='name', values={run[0]: name})
+        nx.set_node_attributes(graph, name='params',
+                               values={run[0]: [sympy.Float(float(p)) for p in params]})
+        for n in run[1:]:
+            circuit._remove_op_node(n)
+    return circuit
+
+def _gate_matrix(name, params):
+    """ Returns the matrix of a single qubit gate of merge_1q_gates"""
+    params = [float(p) for p in params]
+    if name == "h":
+        theta, phi, lam = np.pi / 2, 0, np.pi
+    elif name == "u1":
+        theta, phi, lam = 0, 0, params[0]
+    elif name == "u2":
+        theta, phi, lam = np.pi / 2, params[0], params[1]
+    elif name == "u3":
+        theta, phi, lam = params
+    else:
+        return np.eye(2, dtype=complex)
+    c, s = np.cos(theta / 2), np.sin(theta / 2)
+    return np.array([[c, -np.exp(1j * lam) * s],
+                     [np.exp(1j * phi) * s, np.exp(1j * (phi + lam)) * c]])
+
+def _matrix_gate(matrix):
+    """
+    Finds the gate of a single qubit unitary, up to a global phase.
+
+    Args:
+        matrix(ndarray) : the 2x2 unitary
+
+    Returns:
+        name, params
+        name(str)     : "u1", "u2" or "u3", None for the identity
+        params(list)  : the parameters of the gate as floats
+    """
+    c, s = abs(matrix[0, 0]), abs(matrix[1, 0])
+    theta = 2 * np.arctan2(s, c)
+    # The phase is chosen such that the entry cos(theta / 2) is real, or
+    # the entry e^(i phi) sin(theta / 2) if the cosine vanishes, with phi = 0
+    if c > ANGLE_TOLERANCE:
+        phase = np.angle(matrix[0, 0])
+        lam = np.angle(matrix[1, 1]) - phase
+        phi = 0
+        if s > ANGLE_TOLERANCE:
+            phi = np.angle(matrix[1, 0]) - phase
+            lam = np.angle(-matrix[0, 1]) - phase
+    else:
+        phase = np.angle(matrix[1, 0])
+        phi = 0
+        lam = np.angle(-matrix[0, 1]) - phase
+    # angles in [-pi, pi)
+    phi, lam = ((a + np.pi) % (2 * np.pi) - np.pi for a in (phi, lam))
+    if abs(theta) < ANGLE_TOLERANCE:
+        lam = (phi + lam + np.pi) % (2 * np.pi) - np.pi
+        if abs(lam) < ANGLE_TOLERANCE:
+            return None, []
+        return "u1", [lam]
+    if abs(theta - np.pi / 2) < ANGLE_TOLERANCE:
+        return "u2", [phi, lam]
+    return "u3", [theta, phi, lam]
+
+def my_swap_mapper(circuit_graph, coupling_map, speedup = False, initial_layout = None, processes = None,
+                   budget = None, engine = "tree", beam_width = BEAM_WIDTH, lookahead = LOOKAHEAD,
+                   bridges = BRIDGES, gate_costs = None, edge_costs = None, seed = SEED):
+    """
+    Maps the circuit to the coupling by inserting swaps, which are found by a
+    tree search over the most promising swaps.
+
+    Internally all qubits are dense integers: physical qubit i is the i-th
+    qubit of the coupling map in sorted order and logical qubits are numbered
+    by the physical qubit with the same name. A layout is stored as a pair of
+    permutation lists, layout[logical] = physical and
+    inverse[physical] = logical, so that applying a swap only exchanges two
+    entries of each.
+
+    Args:
+        circuit_graph(DAGCircuit): The circuit to map
+        coupling_map(dict)       : coupling map for device topology
+        speedup(bool)            : If true, use a smaller search depth
+        initial_layout(dict)     : mapping from the qubits of the circuit to
+                                   the qubits of the coupling. Trivial if None
+        processes(int)           : If given, the leaves of the tree are
+                                   expanded by up to this many worker
+                                   processes, see SearchProcesses. This
+                                   pays off for large devices and deep
+                                   trees
+        budget(Budget)           : If given, the depth and width of the tree
+                                   are adapted to the budget. When it is used
+                                   up, the remaining gates are routed along
+                                   shortest paths without searching
+        engine(str)              : "tree" searches a tree of the next swaps
+                                   that is kept and extended while mapping,
+                                   see route. "beam" keeps only the best
+                                   beam_width partial solutions, see
+                                   beam_route. speedup and processes only
+                                   apply to the tree
+        beam_width(int)          : number of partial solutions of the beam
+        lookahead(int)           : number of cnots of every qubit after the
+                                   front layer that are included in the
+                                   scores, with decaying weights. See
+                                   FrontLayer.weighted_distance
+        bridges(bool)            : If true, the tree may execute cnots at
+                                   distance two by a bridge of four cnots
+                                   instead of a swap
+        gate_costs(dict)         : costs of the gates, which weight the
+                                   cnots and swaps in the search, see
+                                   get_device. DEFAULT_GATE_COSTS if None
+        edge_costs(dict)         : costs of the cnots on each edge, see
+                                   compiler_function
+        seed(int)                : seed of the random tie breaking of the
+                                   search
+
+    Returns:
+        The mapped circuit as a new DAGCircuit, with the same basis as
+        circuit_graph and the swaps expanded into three cnots each
+    """
+    device = get_device(coupling_map, gate_costs, edge_costs)
+    qubits = device["qubits"]
+    gates = read_gates(circuit_graph, device["index"])
+    layout, inverse = layout_permutation(initial_layout, device)
+    compiled_dag = new_output_circuit(circuit_graph, qubits)
+    rng = np.random.RandomState(seed)
     # Set the depth we are actually going to use. If speedup is true, use
     # a depth one smaller than usually
     used_depth = DEPTH
     if speedup:
         used_depth -= 1
-    # This value gives a good compromise between speed and final score
-    max_gates = 50 + 10 * len(coupling.get_qubits())
+    if engine == "tree":
+        route(gates, device, layout, inverse, compiled_dag, used_depth, processes, budget,
+              lookahead, bridges, rng)
+    elif engine == "beam":
+        beam_route(gates, device, layout, inverse, compiled_dag, beam_width, budget = budget,
+                   lookahead = lookahead, rng = rng)
+    else:
+        raise MapperError("unknown engine %s" % engine)
 
-    # Build the initial tree
-    node = build_tree(None, gates, coupling, initial_layout, used_depth, width = WIDTH, max_gates = max_gates)
+    # complete the circuit. Measure each qubit where it ended up
+    compiled_dag.apply_operation_back("barrier", list(qubits))
+    for q, c in gates["measures"]:
+        compiled_dag.apply_operation_back("measure", [qubits[layout[q]]], [c])
+    return compiled_dag
+
+def layout_permutation(initial_layout, device):
+    """
+    Turns a layout given as a dictionary into the permutation lists used by
+    the mapper.
+
+    Args:
+        initial_layout(dict) : mapping from the qubits of the circuit to the
+                               qubits of the coupling. Trivial if None
+        device(dict)         : device data as returned by get_device
+
+    Returns:
+        layout, inverse
+        layout(list)  : layout[logical] = physical
+        inverse(list) : inverse[physical] = logical
+    """
+    qubits = device["qubits"]
+    if initial_layout == None:
+        # Start with a trivial layout, compiler_function chooses a better one
+        # with choose_initial_layout
+        initial_layout = {qubit : qubit for qubit in qubits}
+    layout = [None] * len(qubits)
+    inverse = [None] * len(qubits)
+    for q in initial_layout:
+        layout[device["index"][q]] = device["index"][initial_layout[q]]
+    # Qubits that are not used by the circuit still get a place in the
+    # permutation, so that swaps can move them around
+    free = [p for p in range(len(qubits)) if p not in layout]
+    for l in range(len(qubits)):
+        if layout[l] == None:
+            layout[l] = free.pop()
+        inverse[layout[l]] = l
+    return layout, inverse
+
+def route(gates, device, layout, inverse, output = None, used_depth = DEPTH, processes = None,
+          budget = None, lookahead = LOOKAHEAD, bridges = BRIDGES, rng = None):
+    """
+    Inserts the swaps needed to execute all gates, see my_swap_mapper.
+
+    Args:
+        gates(dict)        : gates in the form returned by read_gates
+        device(dict)       : device data as returned by get_device
+        layout(list)       : initial layout, is the final layout on return
+        inverse(list)      : inverse of layout, modified in place
+        output(DAGCircuit) : circuit the gates and swaps are appended to.
+                             If None, the swaps are only counted
+        used_depth(int)    : depth of the search tree
+        processes(int)     : number of processes of the search, see
+                             my_swap_mapper
+        budget(Budget)     : budget of the search, see my_swap_mapper
+        lookahead(int)     : lookahead of the leaf scores, see FrontLayer
+        bridges(bool)      : If true, cnots at distance two may be executed
+                             by a bridge, see choose_bridge
+        rng(RandomState)   : random numbers of the search, see search_swaps
+
+    Returns:
+        The number of swaps and bridges inserted
+    """
+    qubits = device["qubits"]
+    swaps = 0
+    # The state of the circuit at the root of the tree. The nodes of the tree
+    # only store the swaps, the states below the root are recreated from it
+    # while the tree is walked
+    front = FrontLayer(gates, len(qubits), lookahead, gain = device["gain"])
+    executed_gates, cnots = front.execute(range(len(qubits)), device["distance"], layout)
+    if output != None:
+        for g in executed_gates:
+            append_gate(output, gates, g, layout, qubits)
+    workers = None
+    if processes != None:
+        workers = SearchProcesses(processes, gates, device, lookahead, layout)
+    width = WIDTH
+    if budget != None:
+        budget.start(front.remaining)
+    # Swap sequences that lead to the same state are only searched once
+    table = TranspositionTable()
+    node = build_tree(workers, cnots, front, layout, inverse, device, used_depth, width, budget,
+                      table, rng)
     # Now actually start compiling
-    run = True
-    while run:
-        # if no gates are left, stop ater this iteration
-        run = node["remaining_gates"] != []
-        # add the swap of the top node to the qasm string
-        if node["swap"] != None:
-            edge = node["swap"]
-            qasm_string += "swap %s[%d],%s[%d]; " % (edge[0][0],
-                                                    edge[0][1],
-                                                    edge[1][0],
-                                                    edge[1][1])
-        # add all executed gates to the qasm string
-        for gate in node["executed_gates"]:
-            qasm_string += gate_to_qasm(gate, node["layout"])
-        last_layout = node["layout"]
-        # Go one step deeper into the tree. For this, choose the child with the
-        # best score. This is the child whose score matches the score of the node
-        for n in node["children"]:
-            if n["score"] == node["score"]:
-                node = n
+    while front.remaining > 0:
+        if budget != None and budget.expired():
+            swaps += route_directly(output, gates, front, layout, inverse, device)
+            break
+        # A cnot at distance two may be better executed by a bridge, which
+        # does not change the layout
+        bridge = None
+        if bridges:
+            bridge, tree = choose_bridge(node, gates, front, layout, inverse, device, used_depth - 1,
+                                         width, budget, rng)
+        if bridge != None:
+            executed_gates, _ = front.execute_bridge(bridge, device["distance"], layout)
+            swaps += 1
+            if workers != None:
+                workers.bridge(bridge)
+            if output != None:
+                append_bridge(output, gates, bridge, layout, device)
+                for g in executed_gates[1:]:
+                    append_gate(output, gates, g, layout, qubits)
+            node = tree
+        else:
+            # The root is a leaf if everything below it was pruned by the
+            # table and the budget added no layer since. Then search its
+            # swaps first
+            if node.children == None:
+                if workers == None:
+                    table.clear()
+                    update_tree(node, front, layout, inverse, device, width=width, budget=budget,
+                                table=table, rng=rng)
+                else:
+                    parallel_update_tree(workers, node, front, layout, inverse, device,
+                                         width=width, budget=budget, rng=rng)
+            # Go one step deeper into the tree. For this, choose the child with the
+            # best score. This is the child whose score matches the score of the node
+            for n in node.children:
+                if n.score == node.score:
+                    node = n
+                    break
+            # add the swap of the new top node and all gates executed after it to
+            # the output circuit
+            executed_gates, _, _ = descend(node, front, layout, inverse, device)
+            swaps += 1
+            if workers != None:
+                workers.swap(node.swap)
+            if output != None:
+                append_swap(output, node.swap, device)
+                for g in executed_gates:
+                    append_gate(output, gates, g, layout, qubits)
+        used_depth -= 1
+        # append one layer to the tree, or as many as the budget allows
+        layers = 1
+        if budget != None:
+            layers, width = budget.plan(used_depth, width, front.remaining)
+        for _ in range(layers):
+            if workers == None:
+                # The table only holds the states of the layer that is added,
+                # so that a state is never pruned in favour of a node that
+                # was dropped from the tree in the meantime
+                table.clear()
+                update_tree(node, front, layout, inverse, device, width=width, budget=budget,
+                            table=table, rng=rng)
+            else:
+                parallel_update_tree(workers, node, front, layout, inverse, device,
+                                     width=width, budget=budget, rng=rng)
+        used_depth += layers
+    if workers != None:
+        workers.close()
+    return swaps
+
+class BeamEntry:
+    """
+    A partial solution of the beam search: the state of the circuit after a
+    sequence of swaps.
+
+    Attributes:
+        layout(list)    : layout after the swaps
+        inverse(list)   : inverse of layout
+        heads(list)     : heads of the FrontLayer after the swaps
+        front(set)      : front layer after the swaps
+        remaining(int)  : number of gates not executed yet
+        cnots(int)      : number of cnots executed
+        path(tuple)     : the swaps as a linked list (swap, path of the
+                          parent), None if there are no swaps
+    """
+    __slots__ = ("layout", "inverse", "heads", "front", "remaining", "cnots", "path")
+
+    def __init__(self, layout, inverse, front, cnots, path):
+        self.layout = layout
+        self.inverse = inverse
+        self.heads = front.heads[:]
+        self.front = set(front.front)
+        self.remaining = front.remaining
+        self.cnots = cnots
+        self.path = path
+
+    def restore(self, front):
+        """ Puts front into the state of this entry"""
+        front.heads = self.heads[:]
+        front.front = set(self.front)
+        front.remaining = self.remaining
+
+def beam_route(gates, device, layout, inverse, output = None, beam_width = BEAM_WIDTH,
+               width = WIDTH, budget = None, lookahead = LOOKAHEAD, rng = None):
+    """
+    Inserts the swaps needed to execute all gates by a beam search. In every
+    step each of the beam_width best partial solutions is extended by its
+    width most promising swaps, and the best beam_width of these are kept for
+    the next step. Discarded partial solutions are never looked at again, so
+    the work per step is proportional to beam_width times the number of edges
+    of the coupling. Partial solutions are scored like the leaves of the tree
+    search. The swaps of the first partial solution that executes all gates
+    are returned. If no gate was executed for as many steps as there are
+    qubits, the closest cnot of the best partial solution is executed along a
+    shortest path and the search starts again from there.
+
+    Args:
+        gates(dict)        : gates in the form returned by read_gates
+        device(dict)       : device data as returned by get_device
+        layout(list)       : initial layout, is the final layout on return
+        inverse(list)      : inverse of layout, modified in place
+        output(DAGCircuit) : circuit the gates and swaps are appended to.
+                             If None, the swaps are only counted
+        beam_width(int)    : number of partial solutions kept
+        width(int)         : number of swaps tried for each partial solution
+        budget(Budget)     : If given and used up, the best partial solution
+                             is completed by route_directly. Every scored
+                             candidate counts as a node
+        lookahead(int)     : lookahead of the scores, see FrontLayer
+        rng(RandomState)   : random numbers breaking the ties of the scores.
+                             The global ones if None
+
+    Returns:
+        The number of swaps inserted
+    """
+    if rng == None:
+        rng = np.random
+    distance = device["distance"]
+    swaps = device["swaps"]
+    qubits = device["qubits"]
+    front = FrontLayer(gates, len(qubits), lookahead, gain = device["gain"])
+    start_layout = layout[:]
+    _, cnots = front.execute(range(len(qubits)), distance, start_layout)
+    beam = [BeamEntry(start_layout, inverse[:], front, cnots, None)]
+    if budget != None:
+        budget.start(front.remaining)
+    fewest_remaining = front.remaining
+    stalled = 0
+    while all(entry.remaining > 0 for entry in beam):
+        if budget != None and budget.expired():
+            break
+        if stalled > len(qubits):
+            # The scores do not lead anywhere, execute the closest cnot of
+            # the best entry along a shortest path and start again from there
+            entry = beam[0]
+            entry.restore(front)
+            l, inv, path, c = entry.layout[:], entry.inverse[:], entry.path, entry.cnots
+            for edge in shortest_path_swaps(front, l, device):
+                apply_swap(l, inv, edge)
+                c += front.execute([inv[edge[0]], inv[edge[1]]], distance, l)[1]
+                path = (edge, path)
+            beam = [BeamEntry(l, inv, front, c, path)]
+            fewest_remaining = front.remaining
+            stalled = 0
+            continue
+        # Score the most promising swaps of every entry. The swaps are
+        # executed and undone, only the kept ones are executed again below
+        candidates = []
+        table = TranspositionTable()
+        for i, entry in enumerate(beam):
+            if budget != None and candidates and budget.expired():
+                # Keep the entries scored so far, the loop above stops
                 break
-        # append one layer to the tree
-        update_tree(node, coupling, width=WIDTH, max_gates = max_gates)
-
-    # complete the qasm string
-    swap_decl = "gate swap a,b { cx a,b; cx b,a; cx a,b;}"
-    end_str = "barrier "    # end of the qasm code
-    for q in coupling.get_qubits():
-        end_str += "%s[%d]," % q
-    end_str = end_str[:-1]+";\n"
-    # Assume that each qubit q[i] gets measured to c[i]
-    for q in circuit_graph.get_qubits():
-        end_str += qubit_to_measure_string(q, last_layout, q[1])
-    qasm_string = circuit_graph.qasm(decls_only=True)+swap_decl+qasm_string+end_str
-    # convert qasm to a dag circuit
-    basis = "u1,u2,u3,cx,id,swap"
-    ast = Qasm(data=qasm_string).parse()
-    u = unroll.Unroller(ast, unroll.DAGBackend(basis.split(",")))
-    return u.execute()
-
-def build_tree(swap, gates, coupling, layout, depth, width = WIDTH, max_gates = 1000000, cnot_count = 0):
-    """
-    Searched through multiple swaps recursively and builds a tree of all swaps
-    searched
+            entry.restore(front)
+            l, inv = entry.layout, entry.inverse
+            differences = score_swaps(front.upcoming_cnots(), device, l)
+            order = np.lexsort((rng.random_sample(len(differences)), -differences))
+            for j in order[:width]:
+                edge = tuple(swaps[j].tolist())
+                saved_front = set(front.front)
+                apply_swap(l, inv, edge)
+                executed_gates, c = front.execute([inv[edge[0]], inv[edge[1]]], distance, l)
+                if table.visit((tuple(l), tuple(front.heads))):
+                    if budget != None:
+                        budget.nodes += 1
+                    dist = front.weighted_distance(distance, l)
+                    candidates.append((entry.cnots + c - device["swap_penalty"][j] - 0.01 * dist,
+                                       rng.random_sample(), i, j))
+                front.undo(executed_gates, saved_front)
+                apply_swap(l, inv, edge)
+        # Build the entries of the next step
+        next_beam = []
+        for _, _, i, j in heapq.nlargest(beam_width, candidates):
+            entry = beam[i]
+            entry.restore(front)
+            l, inv = entry.layout[:], entry.inverse[:]
+            edge = tuple(swaps[j].tolist())
+            apply_swap(l, inv, edge)
+            _, c = front.execute([inv[edge[0]], inv[edge[1]]], distance, l)
+            next_beam.append(BeamEntry(l, inv, front, entry.cnots + c - device["swap_penalty"][j],
+                                       (edge, entry.path)))
+        beam = next_beam
+        stalled += 1
+        remaining = min(entry.remaining for entry in beam)
+        if remaining < fewest_remaining:
+            fewest_remaining = remaining
+            stalled = 0
+    best = min(beam, key=lambda entry: entry.remaining)
+    if best.remaining > 0:
+        # The first entry is the best one, since nlargest sorts
+        best = beam[0]
+    path = []
+    p = best.path
+    while p != None:
+        path.append(p[0])
+        p = p[1]
+    path.reverse()
+
+    # Replay the swaps of the best entry to build the output
+    front = FrontLayer(gates, len(qubits))
+    executed_gates, _ = front.execute(range(len(qubits)), distance, layout)
+    if output != None:
+        for g in executed_gates:
+            append_gate(output, gates, g, layout, qubits)
+    for edge in path:
+        apply_swap(layout, inverse, edge)
+        executed_gates, _ = front.execute([inverse[edge[0]], inverse[edge[1]]], distance, layout)
+        if output != None:
+            append_swap(output, edge, device)
+            for g in executed_gates:
+                append_gate(output, gates, g, layout, qubits)
+    return len(path) + route_directly(output, gates, front, layout, inverse, device)
+
+def build_tree(workers, cnots, front, layout, inverse, device, depth, width, budget, table,
+               rng = None):
+    """
+    Builds the search tree below a new root.
 
     Args:
-        swap(pair of qubits): The swap the should correspond to the retured node.
-                              Can be None if we are at the root of the tree.
-        gates(list)         : All gates that still have to be executed
-        coupling(Couling)   : coupling for device topology.
-        layout(dict)        : layout after(!) swap has been applied
-        depth(int)          : The depth (not including this node), to which the
-                              tree should be build
-        width(int)          : Maximum number of swaps to be searched through at
-                              each node
-        max_gates(int)      : Maximum number of gates considered
-        cnot_count(int)     : The number of cnots executed so far
+        workers(SearchProcesses) : workers of the parallel search, or None
+        cnots(float)      : cnots executed at the root
+        front, layout, inverse : state at the root
+        device(dict)      : device data as returned by get_device
+        depth(int)        : depth of the tree
+        width(int)        : number of swaps searched for each node
+        budget(Budget)    : budget the nodes are counted against, or None
+        table(TranspositionTable) : table of the searched states
+        rng(RandomState)  : random numbers of the search, see search_swaps
 
     Returns:
-        the top node of a tree containing all swaps searched.
-        A node is a dictionary of the form:
-            "swap"            : The swap searched in this node
-            "layout"          : The layout after the swap has been applied
-            "executed_gates"  : All gates that can be executed in accordance with
-                                the coupling after the swaps
-            "remaining_gates" : All gates that still could not be executed
-            "cnots"           : Number of total cnot executed after this node
-            "children"        : List of nodes searched through starting from this
-                                node. Is None if depth = 0
-            "score"           : score of the node. If the node has children, it
-                                is the maximum of the children score. Otherwise
-                                it is evatuated from cnots and layout
-    """
-    node = {}
-    node["swap"] = swap
-    node["layout"] = layout
-    executed_gates, remaining_gates, cnots = execute_free_gates(gates, coupling, layout)
-    node["executed_gates"] = executed_gates
-    node["remaining_gates"] = remaining_gates
-    node["cnots"] = cnots + cnot_count
-
-    # if we are at the end of the tree, score the node
-    if depth == 0:
-        upcoming_cnots = get_upcoming_cnots(node["remaining_gates"], len(coupling.get_qubits()))
-        dist = calculate_total_distance(upcoming_cnots, coupling, layout)
-        # We score using the number of cnots that can be executed and use the
-        # current distance as tie-breaker
-        score = node["cnots"] - 0.01 * dist
-        node["score"] = score
-        node["children"] = None
-        return node
-
-    # if we are not at the end of the tree, search through swaps after this swap
-    node["score"], node["children"] = search_swaps(node, coupling, depth, width)
+        The root of the tree
+    """
+    node = Node(None, cnots)
+    if workers == None:
+        node.score, node.children = search_swaps(node, front, layout, inverse, device, depth,
+                                                 width = width, budget = budget, table = table,
+                                                 rng = rng)
+    else:
+        # The workers are at the state of the root, so the tree is built
+        # layer by layer
+        for _ in range(depth):
+            parallel_update_tree(workers, node, front, layout, inverse, device, width = width,
+                                 budget = budget, rng = rng)
     return node
 
-def update_tree(node, coupling, width = WIDTH, max_gates = 1000000):
+def choose_bridge(node, gates, front, layout, inverse, device, depth, width, budget, rng = None):
+    """
+    Decides whether a cnot of the front layer whose qubits are at distance
+    two should be executed by a bridge instead of doing the best swap of the
+    tree. A bridge costs four cnots, about as much as a swap and the cnot,
+    but does not change the layout. So a bridge is treated as one more move
+    of the search, valued with the costs of its cnots like a swap followed
+    by the cnot, see "bridge_gain" of get_device: a tree is built after it,
+    and it is taken if that tree scores better than the tree of the swaps.
+
+    Args:
+        node(Node)        : the root of the tree
+        gates(dict)       : gates in the form returned by read_gates
+        front, layout, inverse : state at the root
+        device(dict)      : device data as returned by get_device
+        depth(int)        : depth of the tree built after the bridge
+        width(int)        : number of swaps searched for each node
+        budget(Budget)    : budget the nodes are counted against, or None
+        rng(RandomState)  : random numbers of the search, see search_swaps
+
+    Returns:
+        bridge, tree
+        bridge(int) : the gate to execute by a bridge, or None if the swap
+                      is better
+        tree(Node)  : the tree to continue with after the bridge
+    """
+    distance = device["distance"]
+    cx = gates["names"].index("cx") if "cx" in gates["names"] else None
+    candidates = [g for g in front.front
+                  if gates["ops"][g] == cx and distance[layout[gates["qubits"][g][0]],
+                                                         layout[gates["qubits"][g][1]]] == 2]
+    bridge, tree = None, None
+    best = node.score
+    for g in sorted(candidates):
+        saved_front = set(front.front)
+        gain = device["bridge_gain"][layout[gates["qubits"][g][0]], layout[gates["qubits"][g][1]]]
+        executed_gates, cnots = front.execute_bridge(g, distance, layout, gain)
+        if depth > 0:
+            n = build_tree(None, node.cnots + cnots, front, layout, inverse, device, depth, width,
+                           budget, TranspositionTable(), rng)
+        else:
+            n = Node(None, node.cnots + cnots)
+        if n.children == None:
+            n.score = n.cnots - 0.01 * front.weighted_distance(distance, layout)
+        front.undo(executed_gates, saved_front)
+        if n.score > best:
+            best, bridge, tree = n.score, g, n
+    return bridge, tree
+
+def choose_initial_layout(circuit_graph, coupling_map, method = "reverse", time_budget = None,
+                          gate_costs = None, edge_costs = None, seed = SEED):
+    """
+    Chooses the initial layout for my_swap_mapper.
+
+    Args:
+        circuit_graph(DAGCircuit): The circuit to map
+        coupling_map(dict)       : coupling map for device topology
+        method(str)              : one of the keys of PLACEMENTS
+        time_budget(float)       : If given, the placement returns the best
+                                   layout found after about this many seconds
+        gate_costs(dict)         : costs of the gates, see my_swap_mapper
+        edge_costs(dict)         : costs of the cnots on each edge, see
+                                   compiler_function
+        seed(int)                : seed of the random tie breaking of the
+                                   searches of the placement
+
+    Returns:
+        The initial layout as a dictionary mapping the qubits of the circuit
+        to the qubits of the coupling, both in the form (Register, Index)
+    """
+    if method not in PLACEMENTS:
+        raise MapperError("unknown placement %s" % method)
+    device = get_device(coupling_map, gate_costs, edge_costs)
+    qubits = device["qubits"]
+    gates = read_gates(circuit_graph, device["index"])
+    layout = PLACEMENTS[method](gates, device, time_budget, np.random.RandomState(seed))
+    return {qubits[l] : qubits[p] for l, p in enumerate(layout)}
+
+def trivial_placement(gates, device, time_budget = None, rng = None):
+    """ Places every qubit of the circuit on the physical qubit with the same
+        name"""
+    return list(range(len(device["qubits"])))
+
+def interaction_placement(gates, device, time_budget = None, rng = None):
+    """
+    Places the qubits greedily, such that qubits sharing many cnots are close
+    to each other in the coupling. Cnots at the start of the circuit count
+    more, since the layout changes while the circuit is mapped.
+
+    Args:
+        gates(dict)        : gates in the form returned by read_gates
+        device(dict)       : device data as returned by get_device
+        time_budget(float) : not used, the placement is fast
+        rng(RandomState)   : not used, the placement is deterministic
+
+    Returns:
+        The layout as a list, layout[logical] = physical
+    """
+    distance = device["distance"]
+    n = len(device["qubits"])
+    # The weight of the interaction of each pair of qubits
+    weight = np.zeros((n, n))
+    cnots = [q for q in gates["qubits"] if len(q) == 2]
+    for i, (q1, q2) in enumerate(cnots):
+        w = 1 - i / len(cnots)
+        weight[q1, q2] += w
+        weight[q2, q1] += w
+    layout = [None] * n
+    free = set(range(n))
+    # The qubit with the most interaction goes to the center of the coupling
+    first = int(np.argmax(weight.sum(axis=1)))
+    center = int(np.argmin(distance.sum(axis=1)))
+    layout[first] = center
+    free.discard(center)
+    placed = [first]
+    unplaced = set(range(n)) - {first}
+    while unplaced:
+        # Place the qubit interacting most with the placed ones where it is
+        # closest to them
+        q = max(sorted(unplaced), key=lambda l: weight[l, placed].sum())
+        targets = [layout[l] for l in placed]
+        p = min(sorted(free), key=lambda p: (weight[q, placed] * distance[p, targets]).sum())
+        layout[q] = p
+        free.discard(p)
+        placed.append(q)
+        unplaced.discard(q)
+    return layout
+
+def reverse_placement(gates, device, time_budget = None, rng = None):
+    """
+    Refines the interaction placement by mapping the circuit forwards and
+    backwards. The layout at the end of a backward pass is a good initial
+    layout, since it fits the first gates of the circuit. The layout needing
+    the fewest swaps in the forward pass is returned, so the placement ends
+    with a forward pass.
+
+    Args:
+        gates(dict)        : gates in the form returned by read_gates
+        device(dict)       : device data as returned by get_device
+        time_budget(float) : If given, no new pass is started after this many
+                             seconds and the running passes stop searching.
+                             Else LAYOUT_PASSES forward passes are done
+        rng(RandomState)   : random numbers of the searches of the passes
+
+    Returns:
+        The layout as a list, layout[logical] = physical
+    """
+    start = time.perf_counter()
+    reverse_gates = {"names": gates["names"], "ops": gates["ops"][::-1],
+                     "qubits": gates["qubits"][::-1], "params": gates["params"][::-1],
+                     "measures": []}
+    layout = interaction_placement(gates, device)
+    best_layout, best_swaps = None, None
+    def remaining_budget():
+        if time_budget == None:
+            return None
+        return Budget(max(time_budget - (time.perf_counter() - start), 0))
+
+    passes = 0
+    while True:
+        # Forward pass, to score the layout. Its final layout is the start of
+        # the backward pass
+        candidate = layout[:]
+        inverse = [None] * len(layout)
+        for l, p in enumerate(layout):
+            inverse[p] = l
+        swaps = route(gates, device, layout, inverse, used_depth=LAYOUT_DEPTH,
+                      budget=remaining_budget(), rng=rng)
+        if best_swaps == None or swaps < best_swaps:
+            best_layout, best_swaps = candidate, swaps
+        passes += 1
+        # A backward pass is only useful if a forward pass scores its layout
+        if time_budget == None:
+            if passes >= LAYOUT_PASSES:
+                break
+        elif time.perf_counter() - start >= time_budget:
+            break
+        route(reverse_gates, device, layout, inverse, used_depth=LAYOUT_DEPTH,
+              budget=remaining_budget(), rng=rng)
+    return best_layout
+
+# The available methods to choose the initial layout, see
+# choose_initial_layout
+PLACEMENTS = {"trivial": trivial_placement, "interaction": interaction_placement,
+              "reverse": reverse_placement}
+
+def stream_swap_mapper(operations, coupling_map, initial_layout = None, window = WINDOW,
+                       gate_costs = None, edge_costs = None, lookahead = LOOKAHEAD, seed = SEED):
+    """
+    Maps a circuit like my_swap_mapper, but reads the operations from an
+    iterator and yields the mapped operations as soon as the search commits
+    to them. Only the next window operations that are not executed yet are
+    kept in memory, so the memory does not grow with the length of the
+    circuit. The search cannot see beyond the window and a tree of depth
+    DEPTH is used, without budget, bridges or parallel search.
+
+    Like in my_swap_mapper, the measurements are done at the end, after a
+    barrier, on the physical qubits where the measured qubits ended up.
+    A gate on a qubit after its measurement raises a MapperError.
+
+    Args:
+        operations(iterable) : the operations of the circuit as tuples
+                               (name, qargs, params, cargs), e.g. as returned
+                               by read_qasm_operations. The qubits and clbits
+                               are in the form (Register, Index)
+        coupling_map(dict)   : coupling map for device topology
+        initial_layout(dict) : see my_swap_mapper
+        window(int)          : number of operations kept in memory
+        gate_costs(dict)     : costs of the gates, see my_swap_mapper
+        edge_costs(dict)     : costs of the cnots on each edge, see
+                               compiler_function
+        lookahead(int)       : lookahead of the leaf scores, see FrontLayer
+        seed(int)            : seed of the random tie breaking of the search
+
+    Returns:
+        A generator of the mapped operations (name, qargs, params, cargs),
+        on the qubits of the coupling. Swaps are expanded into three cnots
+    """
+    device = get_device(coupling_map, gate_costs, edge_costs)
+    qubits = device["qubits"]
+    distance = device["distance"]
+    layout, inverse = layout_permutation(initial_layout, device)
+    operations = iter(operations)
+    gates = {"names": [], "ops": [], "qubits": [], "params": []}
+    front = FrontLayer(gates, len(qubits), lookahead, gain = device["gain"])
+    op_ids = {}
+    measures = []
+    measured = set()
+    exhausted = False
+    rng = np.random.RandomState(seed)
+
+    def load():
+        """ Reads operations until the window is full and returns the
+            qubits whose head may have become executable"""
+        nonlocal exhausted
+        touched = set()
+        while front.remaining < window and not exhausted:
+            op = next(operations, None)
+            if op == None:
+                exhausted = True
+                break
+            name, qargs, params, cargs = op
+            if name == "barrier":
+                continue
+            if name == "measure":
+                measures.append((device["index"][qargs[0]], cargs[0]))
+                measured.add(qargs[0])
+                continue
+            if len(qargs) > 2:
+                raise MapperError("gates on more than two qubits are not supported")
+            if not measured.isdisjoint(qargs):
+                raise MapperError("gates after the measurement of their qubit are not supported")
+            if name not in op_ids:
+                op_ids[name] = len(gates["names"])
+                gates["names"].append(name)
+            gates["ops"].append(op_ids[name])
+            gates["qubits"].append(tuple(device["index"][q] for q in qargs))
+            gates["params"].append(tuple(params))
+            front.add_gate(len(gates["qubits"]) - 1)
+            touched.update(gates["qubits"][-1])
+        return touched
+
+    def mapped(executed_gates):
+        """ Returns the mapped operations of executed gates"""
+        return [(gates["names"][gates["ops"][g]], [qubits[layout[q]] for q in gates["qubits"][g]],
+                 list(gates["params"][g]), []) for g in executed_gates]
+
+    def compact():
+        """ Forgets the executed gates, renumbering the others"""
+        nonlocal gates, front
+        keep = sorted(set(g for q, queue in enumerate(front.queues)
+                          for g in queue[front.heads[q]:]))
+        new_index = {g : i for i, g in enumerate(keep)}
+        gates = {field : [gates[field][g] for g in keep] if field != "names" else gates["names"]
+                 for field in gates}
+        old_front = front.front
+        front = FrontLayer(gates, len(qubits), lookahead, gain = device["gain"])
+        front.front = set(new_index[g] for g in old_front)
+
+    table = TranspositionTable()
+    node = None
+    while True:
+        # Gates that were read now may be executable right away. The scores
+        # of the tree do not include them, which only affects the search
+        executed_gates, _ = front.execute(load(), distance, layout)
+        for op in mapped(executed_gates):
+            yield op
+        if len(gates["qubits"]) - front.remaining > window:
+            compact()
+        if front.remaining == 0:
+            if exhausted:
+                break
+            node = None
+            continue
+        table.clear()
+        if node == None:
+            node = build_tree(None, 0, front, layout, inverse, device, DEPTH, WIDTH, None, table,
+                              rng)
+        else:
+            update_tree(node, front, layout, inverse, device, width=WIDTH, table=table, rng=rng)
+        for n in node.children:
+            if n.score == node.score:
+                node = n
+                break
+        executed_gates, _, _ = descend(node, front, layout, inverse, device)
+        for a, b in swap_cnots(node.swap, device):
+            yield ("cx", [qubits[a], qubits[b]], [], [])
+        for op in mapped(executed_gates):
+            yield op
+    # complete the circuit. Measure each qubit where it ended up
+    yield ("barrier", list(qubits), [], [])
+    for q, c in measures:
+        yield ("measure", [qubits[layout[q]]], [], [c])
+
+def read_qasm_operations(lines):
+    """
+    Reads the operations of a flat QASM circuit, e.g. one written by
+    DAGCircuit.qasm(), statement by statement. Declarations are skipped and
+    gate definitions, conditions and gates that are not in QASM_GATES are
+    not supported. Only barriers may be applied to whole registers.
+
+    Args:
+        lines(iterable) : the lines of the circuit, e.g. an open file
+
+    Returns:
+        A generator of the operations (name, qargs, params, cargs), see
+        stream_swap_mapper
+
+    Raises:
+        MapperError: if a statement is not supported or malformed
+    """
+    registers = {}
+    text = ""
+    for line in lines:
+        # A statement may span several lines, so the text is buffered until
+        # its semicolon
+        text += line.split("//")[0]
+        *statements, text = text.split(";")
+        for statement in statements:
+            statement = statement.strip()
+            if statement:
+                yield from _read_qasm_statement(statement, registers)
+    if text.strip():
+        raise MapperError("statement without semicolon: %s" % text.strip())
+
+def _read_qasm_statement(statement, registers):
+    """ Returns the operations of a single statement of read_qasm_operations.
+        registers maps the names of the registers declared so far to their
+        sizes, and declarations add to it"""
+    match = re.match(r"[A-Za-z_]\w*", statement)
+    if match == None:
+        raise MapperError("malformed statement %s" % statement)
+    name = match.group()
+    rest = statement[len(name):].strip()
+    if name in ("OPENQASM", "include"):
+        return []
+    if name in ("qreg", "creg"):
+        declaration = re.fullmatch(r"([A-Za-z_]\w*)\s*\[\s*(\d+)\s*\]", rest)
+        if declaration == None:
+            raise MapperError("malformed declaration %s" % statement)
+        registers[declaration.group(1)] = int(declaration.group(2))
+        return []
+    if name in ("gate", "opaque", "if"):
+        raise MapperError("%s is not supported by read_qasm_operations" % name)
+    if name != "barrier" and name not in QASM_GATES:
+        raise MapperError("unknown gate %s" % name)
+    params = []
+    if rest.startswith("("):
+        # The closing parenthesis of the parameters
+        depth = 0
+        for end, c in enumerate(rest):
+            depth += {"(": 1, ")": -1}.get(c, 0)
+            if depth == 0:
+                break
+        if depth != 0:
+            raise MapperError("unbalanced parentheses in %s" % statement)
+        params = [_parse_parameter(p) for p in rest[1:end].split(",")]
+        rest = rest[end + 1:]
+    qargs, arrow, cargs = rest.partition("->")
+    qargs = _read_qasm_arguments(qargs, registers, name == "barrier")
+    cargs = _read_qasm_arguments(cargs, registers, False) if arrow else []
+    if name == "barrier":
+        if params or cargs:
+            raise MapperError("malformed barrier %s" % statement)
+    elif (len(params), len(qargs)) != QASM_GATES[name] or len(cargs) != (1 if name == "measure" else 0):
+        raise MapperError("wrong number of arguments in %s" % statement)
+    return [(name, qargs, params, cargs)]
+
+def _read_qasm_arguments(text, registers, whole_registers):
+    """ Returns the bits in the form (Register, Index) of the comma separated
+        arguments in text. If whole_registers is true, an argument may be a
+        register, which stands for all its bits"""
+    bits = []
+    for argument in text.split(","):
+        match = re.fullmatch(r"\s*([A-Za-z_]\w*)\s*(?:\[\s*(\d+)\s*\])?\s*", argument)
+        if match == None or match.group(1) not in registers:
+            raise MapperError("unknown argument %s" % argument.strip())
+        register, index = match.group(1), match.group(2)
+        if index == None:
+            if not whole_registers:
+                raise MapperError("register %s as argument is not supported" % register)
+            bits.extend((register, i) for i in range(registers[register]))
+        elif int(index) < registers[register]:
+            bits.append((register, int(index)))
+        else:
+            raise MapperError("index out of range in %s" % argument.strip())
+    return bits
+
+def _parse_parameter(text):
+    """ Returns the value of a parameter of a QASM operation, which may be an
+        arithmetic expression of numbers and pi with +, -, * and /. Other
+        expressions, e.g. functions or powers, raise a MapperError"""
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = QASM_TOKEN.match(text, position)
+        if match == None:
+            raise MapperError("unsupported parameter %s" % text)
+        tokens.append(match.group(1))
+        position = match.end()
+    tokens.append(None)
+    i = 0
+
+    # Recursive descent over the tokens, each function reads the tokens of
+    # one level of precedence starting at tokens[i]
+    def expression():
+        nonlocal i
+        value = term()
+        while tokens[i] in ("+", "-"):
+            operator = tokens[i]
+            i += 1
+            if operator == "+":
+                value += term()
+            else:
+                value -= term()
+        return value
+
+    def term():
+        nonlocal i
+        value = factor()
+        while tokens[i] in ("*", "/"):
+            operator = tokens[i]
+            i += 1
+            if operator == "*":
+                value *= factor()
+            else:
+                value /= factor()
+        return value
+
+    def factor():
+        nonlocal i
+        token = tokens[i]
+        i += 1
+        if token in ("+", "-"):
+            return factor() if token == "+" else -factor()
+        if token == "(":
+            value = expression()
+            if tokens[i] != ")":
+                raise MapperError("unsupported parameter %s" % text)
+            i += 1
+            return value
+        if token == "pi":
+            return math.pi
+        if token in (None, "*", "/", ")"):
+            raise MapperError("unsupported parameter %s" % text)
+        return float(token)
+
+    try:
+        value = expression()
+    except (ZeroDivisionError, RecursionError):
+        raise MapperError("unsupported parameter %s" % text)
+    if tokens[i] != None:
+        raise MapperError("unsupported parameter %s" % text)
+    return value
+
+def get_device(coupling_map, gate_costs = None, edge_costs = None):
+    """
+    Returns the data of the coupling the mapper needs, with all qubits
+    replaced by their integer index. The data is computed once per coupling
+    map and costs and then taken from a cache, so it must not be modified.
+
+    The search maximizes the number of executed cnots, so the costs are
+    turned into corrections of it. A cnot counts less if it is more expensive
+    than the cheapest cnot, e.g. because it has to be reversed by four
+    Hadamards, and a swap counts as fewer executed cnots if it is more
+    expensive than the average swap. The corrections are relative to the
+    cost of the average swap, which is roughly the cost of executing one
+    cnot in a mapped circuit.
+
+    Args:
+        coupling_map(dict): coupling map for device topology
+        gate_costs(dict)  : costs of the gates, DEFAULT_GATE_COSTS if None
+        edge_costs(dict)  : costs of the cnots on each edge, see
+                            compiler_function
+
+    Returns:
+        A dictionary with the fields
+            "qubits"  : List of all qubits in the form (Register, Index). The
+                        position in this list is the integer index of a qubit
+            "index"   : Inverse of "qubits", maps (Register, Index) to int
+            "edges"   : List of all edges of the coupling as pairs of ints
+            "swaps"   : Read-only numpy array of shape (swaps, 2) containing
+                        every edge once, regardless of its direction
+            "distance": Read-only numpy array, distance[p1, p2] is the
+                        distance of the qubits p1 and p2 in the coupling
+            "directed": Read-only boolean numpy array, directed[p1, p2] is
+                        True if the coupling allows a cnot from p1 to p2
+            "gain"    : Read-only numpy array, gain[p1, p2] is the value of
+                        executing a cnot from p1 to p2 in the search. 1 for
+                        the cheapest cnots
+            "swap_penalty": Read-only numpy array, the number of cnots each
+                        swap of "swaps" counts less than an average swap
+            "bridge_gain": Read-only numpy array, bridge_gain[p1, p2] is the
+                        value of executing a cnot from p1 to p2 at distance
+                        two by a bridge, in the units of "gain", counting the
+                        bridge as a move like a swap. -inf if the qubits are
+                        not at distance two
+            "bridge_middle": Read-only numpy array, bridge_middle[p1, p2] is
+                        the qubit between p1 and p2 over which the bridge is
+                        cheapest
+    """
+    if gate_costs == None:
+        gate_costs = DEFAULT_GATE_COSTS
+    cx = gate_costs.get("cx", gate_costs.get("CX", 1))
+    h = gate_costs.get("u2", 0)
+    edges = ()
+    if edge_costs != None:
+        edges = tuple(sorted((q, t, c) for q, targets in edge_costs.items()
+                             for t, c in targets.items()))
+    return _build_device(coupling_key(coupling_map), (cx, h, edges))
+
+def coupling_key(coupling_map):
+    """ Returns a hashable representation of coupling_map that does not
+        depend on the order of its keys and lists"""
+    return tuple(sorted((q, tuple(sorted(targets)))
+                        for q, targets in coupling_map.items()))
+
+@lru_cache(maxsize=DEVICE_CACHE_SIZE)
+def _build_device(key, costs):
+    """ Builds the device data for the coupling map given by key and the
+        costs (cost of a cnot, cost of a Hadamard, costs of the edges), see
+        get_device"""
+    physical = sorted(set(q for q, _ in key) | set(t for _, targets in key for t in targets))
+    qubits = [("q", q) for q in physical]
+    index = {q : i for i, q in enumerate(qubits)}
+    edges = [(index[("q", q)], index[("q", t)]) for q, targets in key for t in targets]
+    # The coupling is undirected for the purpose of distances, since the
+    # direction of a cnot can be changed afterwards
+    neighbours = [[] for _ in qubits]
+    for p1, p2 in edges:
+        neighbours[p1].append(p2)
+        neighbours[p2].append(p1)
+    # Breadth first search from every qubit
+    distance = np.full((len(qubits), len(qubits)), len(qubits), dtype=int)
+    for start in range(len(qubits)):
+        distance[start, start] = 0
+        layer = [start]
+        while layer:
+            next_layer = []
+            for p in layer:
+                for n in neighbours[p]:
+                    if distance[start, n] > distance[start, p] + 1:
+                        distance[start, n] = distance[start, p] + 1
+                        next_layer.append(n)
+            layer = next_layer
+    distance.setflags(write=False)
+    directed = np.zeros((len(qubits), len(qubits)), dtype=bool)
+    for p1, p2 in edges:
+        directed[p1, p2] = True
+    directed.setflags(write=False)
+    swaps = np.array(sorted(set(tuple(sorted(e)) for e in edges)), dtype=int).reshape(-1, 2)
+    swaps.setflags(write=False)
+    # The cost of a cnot along each edge, and against it, where it needs
+    # four Hadamards
+    cx, h, edge_costs = costs
+    cost = np.full((len(qubits), len(qubits)), np.inf)
+    for p1, p2 in edges:
+        cost[p1, p2] = cx
+    for q, t, c in edge_costs:
+        cost[index[("q", q)], index[("q", t)]] = c
+    cost = np.minimum(cost, cost.T + 4 * h)
+    # A swap consists of two cnots in the cheaper direction and one in the
+    # other
+    swap_cost = np.array([2 * min(cost[p1, p2], cost[p2, p1]) + max(cost[p1, p2], cost[p2, p1])
+                          for p1, p2 in swaps.tolist()])
+    average = max(swap_cost.mean(), 1e-9) if len(swap_cost) else 1
+    gain = 1 - (cost - cost[np.isfinite(cost)].min()) / average if len(swap_cost) else cost
+    gain.setflags(write=False)
+    swap_penalty = (swap_cost - average) / average
+    swap_penalty.setflags(write=False)
+    # A bridge executes a cnot from p1 to p2 by the cnots p1 -> m, m -> p2,
+    # p1 -> m, m -> p2. A swap followed by a cnot counts
+    # 1 - swap_penalty + gain = 2 - (swap cost + cnot cost - cheapest cnot)
+    # / average in the search, so a bridge of the same cost counts the same
+    bridge_gain = np.full((len(qubits), len(qubits)), -np.inf)
+    bridge_middle = np.zeros((len(qubits), len(qubits)), dtype=int)
+    if len(swap_cost):
+        for p1, p2 in zip(*np.nonzero(distance == 2)):
+            middles = np.flatnonzero((distance[p1] == 1) & (distance[p2] == 1))
+            bridge_cost = 2 * cost[p1, middles] + 2 * cost[middles, p2]
+            m = int(np.argmin(bridge_cost))
+            bridge_gain[p1, p2] = 2 - (bridge_cost[m] - cost[np.isfinite(cost)].min()) / average
+            bridge_middle[p1, p2] = middles[m]
+    bridge_gain.setflags(write=False)
+    bridge_middle.setflags(write=False)
+    return {"qubits": qubits, "index": index, "edges": edges, "swaps": swaps,
+            "distance": distance, "directed": directed, "gain": gain,
+            "swap_penalty": swap_penalty, "bridge_gain": bridge_gain,
+            "bridge_middle": bridge_middle}
+
+class Node:
+    """
+    A node of the search tree. A node only stores what changed compared to
+    its parent, the state of the circuit (layout and front layer) is
+    recreated by descend while the tree is walked from the root.
+
+    Attributes:
+        swap(pair of ints) : The swap searched in this node. None at the root
+        cnots(int)         : Number of total cnots executed after this node
+        score(float)       : score of the node. If the node has children, it
+                             is the maximum of the children score. Otherwise
+                             it is evaluated from cnots and layout
+        children(list)     : List of nodes searched through starting from this
+                             node. None if the node is a leaf
+    """
+    __slots__ = ("swap", "cnots", "score", "children")
+
+    def __init__(self, swap, cnots):
+        self.swap = swap
+        self.cnots = cnots
+        self.score = None
+        self.children = None
+
+def descend(node, front, layout, inverse, device):
+    """
+    Turns the state of the parent of node into the state of node, by applying
+    the swap of node and executing all gates that become executable.
+
+    Args:
+        node(Node)        : The node to go to
+        front(FrontLayer) : front layer of the parent, advanced in place
+        layout(list)      : layout of the parent, modified in place
+        inverse(list)     : inverse of layout, modified in place
+        device(dict)      : device data as returned by get_device
+
+    Returns:
+        executed_gates, cnots, saved_front
+        executed_gates(list) : indices of the gates executed after the swap
+        cnots(int)           : number of cnots in executed_gates
+        saved_front(set)     : front layer of the parent, needed by ascend
+    """
+    saved_front = set(front.front)
+    apply_swap(layout, inverse, node.swap)
+    executed_gates, cnots = front.execute([inverse[node.swap[0]], inverse[node.swap[1]]],
+                                          device["distance"], layout)
+    return executed_gates, cnots, saved_front
+
+def ascend(node, front, layout, inverse, executed_gates, saved_front):
+    """ Undoes descend(node, ...), given the values it returned"""
+    front.undo(executed_gates, saved_front)
+    apply_swap(layout, inverse, node.swap)
+
+def update_tree(node, front, layout, inverse, device, width = WIDTH, budget = None, table = None,
+                rng = None):
     """
     Updated a gived tree by adding one layer after the last one
 
     Args:
         node      : The node to append
-        coupling  : couplig for device topology
+        front     : front layer at node
+        layout    : layout at node
+        inverse   : inverse of layout
+        device    : device data as returned by get_device
         width     : Number of swaps searched for each node
-        max_gates : maximum number of gates considered
+        budget    : Budget that the created nodes are counted against
+        table     : TranspositionTable of the states already in the new layer
+        rng       : RandomState of the search, see search_swaps
 
     Returns:
-        Nothing
+        Nothing. front, layout and inverse are unchanged when it returns
     """
     # If the node has no children, build them to depth 1
-    if node["children"] == None:
-        node["score"], node["children"] = search_swaps(node, coupling, 1, width, max_gates = max_gates)
+    if node.children == None:
+        score, node.children = search_swaps(node, front, layout, inverse, device, 1, width,
+                                            budget, table, rng)
+        # If all swaps were searched elsewhere already, the node stays a leaf
+        if node.children != None:
+            node.score = score
     # Else update all the children and the score of this node
     else:
-        node["score"] = -10000
-        for n in node["children"]:
-            update_tree(n, coupling, width=width)
-            if n["score"] > node["score"]:
-                node["score"] = n["score"]
+        node.score = -10000
+        for n in node.children:
+            executed_gates, _, saved_front = descend(n, front, layout, inverse, device)
+            update_tree(n, front, layout, inverse, device, width=width, budget=budget, table=table,
+                        rng=rng)
+            ascend(n, front, layout, inverse, executed_gates, saved_front)
+            if n.score > node.score:
+                node.score = n.score
 
-def search_swaps(node, coupling, depth, width=WIDTH, max_gates = 1000000):
+def parallel_update_tree(workers, node, front, layout, inverse, device, width = WIDTH,
+                         budget = None, rng = None):
     """
-    Searches the most promising swaps and builds the nodes corresponding to
-    them.
+    Like update_tree, adds one layer to the tree, but the swaps of the leaves
+    are searched by the worker processes. The workers are at the state of
+    node, so only the swaps on the path to each leaf are sent to them, and
+    they return the swaps, cnots and scores of the new nodes. A state reached
+    from several leaves is kept only below the first of them, like with the
+    table of update_tree.
 
     Args:
-        node      : The start node containing all fields exept "children" and "score"
-        coupling  : coupling for device topology
+        workers(SearchProcesses) : the workers, at the state of node
+        node      : The node to append
+        front, layout, inverse : state at node, used if the leaves are too
+                    few to send them to the workers. Unchanged when it returns
+        device    : device data as returned by get_device
+        width     : Number of swaps searched for each node
+        budget    : Budget that the created nodes are counted against
+        rng       : RandomState of the search. Every group of SEED_LEAVES
+                    leaves gets its own seed drawn from it, so the result does
+                    not depend on the number of workers, nor on whether the
+                    leaves are expanded by the workers
+
+    Returns:
+        Nothing
+    """
+    if rng == None:
+        rng = np.random
+    leaves = []
+    _collect_leaves(node, (), leaves)
+    seeds = rng.randint(1 << 31, size = (len(leaves) + SEED_LEAVES - 1) // SEED_LEAVES)
+    groups = [(seed, [(path, leaf.cnots) for path, leaf in leaves[i * SEED_LEAVES:
+                                                                  (i + 1) * SEED_LEAVES]])
+              for i, seed in enumerate(seeds)]
+    table = TranspositionTable()
+    i = 0
+    for found, states in workers.expand(groups, width, front, layout, inverse, device):
+        if states != None:
+            states = iter(states)
+        for children in found:
+            leaf = leaves[i][1]
+            i += 1
+            kept = []
+            for swap, cnots, score in children:
+                if states == None or table.visit(next(states)):
+                    n = Node(swap, cnots)
+                    n.score = score
+                    kept.append(n)
+            # If all swaps were searched below another leaf, the node stays a
+            # leaf
+            if kept:
+                leaf.children = kept
+                leaf.score = max(n.score for n in kept)
+            if budget != None:
+                budget.nodes += len(kept)
+    _rescore(node)
+
+def _collect_leaves(node, path, leaves):
+    """ Appends the leaves below node in depth first order to leaves, each as
+        the pair of the swaps leading to it from the root and the leaf"""
+    if node.children == None:
+        leaves.append((path, node))
+        return
+    for n in node.children:
+        _collect_leaves(n, path + (n.swap,), leaves)
+
+def _rescore(node):
+    """ Sets the score of every inner node below node to the maximum of the
+        scores of its children and returns the score of node"""
+    if node.children != None:
+        node.score = max(_rescore(n) for n in node.children)
+    return node.score
+
+class SearchProcesses:
+    """
+    The worker processes of the parallel search. Every worker keeps the
+    state of the circuit at the root of the tree and is told the swaps and
+    bridges route commits to, so the tree itself is never sent between the
+    processes. To add a layer to the tree, the groups of leaves of
+    parallel_update_tree are split into one chunk of consecutive groups per
+    worker, so that every worker gets a single message and the leaves of a
+    chunk share most of their paths. No more workers are started than there
+    are CPUs, and none if that is one, since a worker then only takes turns
+    with the main process. The leaves are then expanded in the main process,
+    which gives the same result.
+
+    Attributes:
+        connections(list) : the pipes to the workers
+        processes(list)   : the worker processes
+        moves(list)       : the moves committed since the workers were last
+                            sent a message, as pairs ("swap", edge) or
+                            ("bridge", gate)
+    """
+
+    def __init__(self, processes, gates, device, lookahead, layout):
+        """
+        Args:
+            processes(int) : maximum number of worker processes
+            gates(dict)    : gates in the form returned by read_gates
+            device(dict)   : device data as returned by get_device
+            lookahead(int) : lookahead of the leaf scores, see FrontLayer
+            layout(list)   : layout at the root, after the gates executable
+                             in the initial layout were executed
+        """
+        self.connections = []
+        self.processes = []
+        self.moves = []
+        if hasattr(os, "sched_getaffinity"):
+            cpus = len(os.sched_getaffinity(0))
+        else:
+            cpus = os.cpu_count() or 1
+        processes = min(processes, cpus)
+        if processes < 2:
+            processes = 0
+        for _ in range(processes):
+            connection, worker_connection = Pipe()
+            process = Process(target = _search_worker,
+                              args = (worker_connection, gates, device, lookahead, layout[:]),
+                              daemon = True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def swap(self, edge):
+        """ Moves the root of the workers by the swap on edge"""
+        self.moves.append(("swap", edge))
+
+    def bridge(self, g):
+        """ Moves the root of the workers by executing gate g by a bridge"""
+        self.moves.append(("bridge", g))
+
+    def expand(self, groups, width, front, layout, inverse, device):
+        """
+        Searches the swaps of groups of leaves. If there are fewer than
+        MIN_WORKER_GROUPS groups per worker, they are searched in this
+        process, which gives the same result.
+
+        Args:
+            groups(list) : pairs of a seed and a list of leaves, each given
+                           as the pair of the swaps leading to it from the root
+                           and its cnots
+            width(int)   : number of swaps searched for each leaf
+            front, layout, inverse : state at the root, unchanged when it
+                           returns
+            device(dict) : device data as returned by get_device
+
+        Returns:
+            For every group the result of _expand_leaves
+        """
+        count = len(self.connections)
+        if count == 0 or len(groups) < MIN_WORKER_GROUPS * count:
+            table = TranspositionTable()
+            return [_expand_leaves(leaves, seed, front, layout, inverse, device, width, table)
+                    for seed, leaves in groups]
+        size = -(-len(groups) // count)
+        for i, connection in enumerate(self.connections):
+            connection.send((self.moves, groups[i * size:(i + 1) * size], width))
+        self.moves = []
+        results = []
+        for connection in self.connections:
+            results += connection.recv()
+        return results
+
+    def close(self):
+        """ Stops the workers"""
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.processes:
+            process.join()
+
+def _search_worker(connection, gates, device, lookahead, layout):
+    """ Main loop of a worker process of SearchProcesses. Applies the moves it
+        is sent to its state and expands the groups of leaves"""
+    distance = device["distance"]
+    inverse = [None] * len(layout)
+    for l, p in enumerate(layout):
+        inverse[p] = l
+    front = FrontLayer(gates, len(device["qubits"]), lookahead, gain = device["gain"])
+    front.execute(range(len(device["qubits"])), distance, layout)
+    while True:
+        message = connection.recv()
+        if message == None:
+            break
+        moves, groups, width = message
+        for kind, move in moves:
+            if kind == "swap":
+                descend(Node(move, 0), front, layout, inverse, device)
+            else:
+                front.execute_bridge(move, distance, layout)
+        connection.send([_expand_leaves(leaves, seed, front, layout, inverse, device, width)
+                         for seed, leaves in groups])
+    connection.close()
+
+def _expand_leaves(leaves, seed, front, layout, inverse, device, width, table = None):
+    """
+    Searches the swaps of a group of leaves, in a worker process or in the
+    main process, see SearchProcesses.expand.
+
+    Args:
+        leaves(list)  : the leaves in depth first order, each given as the
+                        pair of the swaps leading to it from the root and its
+                        cnots
+        seed(int)     : seed of the random numbers of the group
+        front, layout, inverse : state at the root, unchanged when it returns
+        device(dict)  : device data as returned by get_device
+        width(int)    : number of swaps searched for each leaf
+        table(TranspositionTable) : table shared by the groups expanded in
+                        the main process, or None for a table of its own
+
+    Returns:
+        found, states
+        found(list)  : for every leaf the list of its new children, each as
+                       the tuple (swap, cnots, score)
+        states(list) : for every new child the hash of its state, by which
+                       parallel_update_tree finds children with the same
+                       state below different groups. None if table was
+                       given, then the children are unique already
+    """
+    rng = np.random.RandomState(seed)
+    shared = table != None
+    if not shared:
+        table = TranspositionTable()
+    # The nodes from the root to the current leaf, with the values descend
+    # returned for them. Consecutive leaves share the beginning of their path
+    path = []
+    found = []
+    for swaps, cnots in leaves:
+        common = 0
+        while common < min(len(path), len(swaps)) and path[common][0].swap == swaps[common]:
+            common += 1
+        while len(path) > common:
+            n, executed_gates, saved_front = path.pop()
+            ascend(n, front, layout, inverse, executed_gates, saved_front)
+        for edge in swaps[common:]:
+            n = Node(edge, 0)
+            executed_gates, _, saved_front = descend(n, front, layout, inverse, device)
+            path.append((n, executed_gates, saved_front))
+        _, children = search_swaps(Node(None, cnots), front, layout, inverse, device, 1, width,
+                                   table = table, rng = rng)
+        found.append([(n.swap, n.cnots, n.score) for n in children or []])
+    while path:
+        n, executed_gates, saved_front = path.pop()
+        ascend(n, front, layout, inverse, executed_gates, saved_front)
+    if shared:
+        return found, None
+    # The table holds the states of the new children in the order they were
+    # found
+    return found, [hash(state) for state in table.states]
+
+def search_swaps(node, front, layout, inverse, device, depth, width=WIDTH, budget=None, table=None,
+                 rng=None):
+    """
+    Searches the most promising swaps recursively and builds the tree of the
+    nodes corresponding to them.
+
+    Args:
+        node      : The start node
+        front     : front layer at node
+        layout    : layout at node
+        inverse   : inverse of layout
+        device    : device data as returned by get_device
         depth     : The search depth for each swap
         width     : The number of swaps search through
-        max_gates : the maximum number of gates considered
+        budget    : Budget that the created nodes are counted against
+        table     : TranspositionTable of the states already searched. A swap
+                    leading to one of them is skipped
+        rng       : RandomState breaking the ties between the swaps. The
+                    global one if None
 
     Returns:
         score, children
-        score: score of this node, is the maximum of the scores of the children
-        children: all children of this node, each containing one swap searched
-    """
-
-    #calculate the current distance
-    upcoming_cnots = get_upcoming_cnots(node["remaining_gates"], len(coupling.get_qubits()), max_gates = max_gates)
-    current_dist = calculate_total_distance(upcoming_cnots, coupling, node["layout"])
-    # The distance after a swap can differ by at most two. In this dict we group
-    # the swap by this difference
-    swaps_by_difference = {}
-    # A swap is just and edge in the coupling
-    for edge in coupling.get_edges():
-        trial_layout = deepcopy(node["layout"])
-        trial_layout[reverse_layout_lookup(node["layout"], edge[0])] = edge[1]
-        trial_layout[reverse_layout_lookup(node["layout"], edge[1])] = edge[0]
-        trial_dist = calculate_total_distance(upcoming_cnots, coupling, trial_layout)
-        diff = current_dist - trial_dist
-        if diff not in swaps_by_difference:
-            swaps_by_difference[diff] = []
-        # For each swap also record the distance and the layout, so we don't have to
-        # calculate it again
-        swaps_by_difference[diff].append({"edge": edge, "dist": trial_dist, "layout": trial_layout})
-        # If we have already found enough swaps with the maximum difference in
-        # distance, we can stop searching
-        if 2 in swaps_by_difference and len(swaps_by_difference[2]) == width:
-            break
-
-    # Now we determine the swaps that we are going to explore
-    swaps_to_explore = []
-    d = 2
-    for i in range(min(width, len(coupling.get_edges()))):
-        while d not in swaps_by_difference or swaps_by_difference[d] == []:
-            d -= 1
-        r = random.randrange(len(swaps_by_difference[d]))
-        swaps_to_explore.append(swaps_by_difference[d][r])
-        del swaps_by_difference[d][r]
+        score: score of this node, is the maximum of the scores of the children.
+               None if all swaps were skipped
+        children: all children of this node, each containing one swap searched.
+                  None if all swaps were skipped
+    """
+    # The reduction of the total distance of the upcoming cnots for each swap
+    differences = score_swaps(front.upcoming_cnots(), device, layout)
+    # Explore the swaps with the largest reduction first and break ties
+    # randomly
+    if rng == None:
+        rng = np.random
+    order = np.lexsort((rng.random_sample(len(differences)), -differences))
+    swaps = device["swaps"]
 
     # Init the score
     score = -10000
     children = []
-    for i in range(min(width, len(swaps_to_explore))):
-        n = build_tree( swaps_to_explore[i]["edge"],
-                        node["remaining_gates"],
-                        coupling, swaps_to_explore[i]["layout"],
-                        depth-1,
-                        width=width,
-                        max_gates = max_gates,
-                        cnot_count = node["cnots"])
+    for i in order[:width]:
+        edge = tuple(swaps[i].tolist())
+        n = Node(edge, node.cnots - device["swap_penalty"][i])
+        executed_gates, cnots, saved_front = descend(n, front, layout, inverse, device)
+        # Nodes with the same layout and the same executed gates at the same
+        # depth have the same cnots and the same subtree, e.g. if two swaps on
+        # disjoint edges are done in a different order. Only the first one
+        # found is kept
+        if table != None and not table.visit((depth, tuple(layout), tuple(front.heads))):
+            ascend(n, front, layout, inverse, executed_gates, saved_front)
+            continue
+        if budget != None:
+            budget.nodes += 1
+        n.cnots += cnots
+        if depth == 1:
+            # if we are at the end of the tree, score the node
+            dist = front.weighted_distance(device["distance"], layout)
+            # We score using the number of cnots that can be executed and use the
+            # current distance as tie-breaker
+            n.score = n.cnots - 0.01 * dist
+        else:
+            # else search through swaps after this swap
+            n.score, n.children = search_swaps(n, front, layout, inverse, device, depth - 1, width,
+                                               budget, table, rng)
+            if n.children == None:
+                # Everything below was searched elsewhere already, score the
+                # node as a leaf. Its children are built by a later update
+                dist = front.weighted_distance(device["distance"], layout)
+                n.score = n.cnots - 0.01 * dist
+        ascend(n, front, layout, inverse, executed_gates, saved_front)
         children.append(n)
-        if n["score"] > score:
-            score = n["score"]
+        if n.score > score:
+            score = n.score
+    if not children:
+        return None, None
     return score, children
 
+class TranspositionTable:
+    """
+    The states reached in the search tree, so that a state reached by several
+    swap sequences is only searched once. A state is given by the depth left
+    to search, the layout and the heads of the front layer. When the table is
+    full, the oldest states are forgotten.
+    """
+    __slots__ = ("states", "size")
+
+    def __init__(self, size = TABLE_SIZE):
+        """
+        Args:
+            size(int) : maximum number of states remembered
+        """
+        self.states = OrderedDict()
+        self.size = size
+
+    def visit(self, state):
+        """ Adds state to the table. Returns True if it was not in the table
+            before, i.e. if it has to be searched"""
+        if state in self.states:
+            return False
+        self.states[state] = None
+        if len(self.states) > self.size:
+            self.states.popitem(last=False)
+        return True
 
-def execute_free_gates(gates, coupling, layout, max_gates = 10000000):
+    def clear(self):
+        """ Forgets all states"""
+        self.states.clear()
+
+class Budget:
+    """
+    A limit on the wall-clock time and/or the number of tree nodes the swap
+    search may use. The mapper compares the fraction of the budget used with
+    the fraction of gates already mapped and deepens the tree while it is
+    ahead of schedule and makes it shallower and narrower while it is behind.
     """
-    Finds all gates that can be executed with the current layout
+    __slots__ = ("time_budget", "node_budget", "start_time", "nodes", "total_gates")
+
+    def __init__(self, time_budget = None, node_budget = None):
+        """
+        Args:
+            time_budget(float) : seconds the mapper may take from now on,
+                                 unlimited if None
+            node_budget(int)   : tree nodes the mapper may create, unlimited
+                                 if None
+        """
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.start_time = time.perf_counter()
+        self.nodes = 0
+        self.total_gates = 0
+
+    def start(self, total_gates):
+        """ Starts counting the nodes, total_gates is the number of gates to
+            map. The clock runs since the budget was created, so the time
+            spent before the search is counted as well"""
+        self.nodes = 0
+        self.total_gates = total_gates
+
+    def used(self):
+        """ Returns the fraction of the budget used so far"""
+        used = 0
+        if self.time_budget != None:
+            elapsed = time.perf_counter() - self.start_time
+            used = max(used, elapsed / self.time_budget if self.time_budget > 0 else 1)
+        if self.node_budget != None:
+            used = max(used, self.nodes / self.node_budget if self.node_budget > 0 else 1)
+        return used
+
+    def expired(self):
+        """ Returns True if the budget is used up"""
+        return self.used() >= 1
+
+    def plan(self, depth, width, remaining_gates):
+        """
+        Decides how to extend the tree in the next step.
+
+        Args:
+            depth(int)           : current depth of the tree
+            width(int)           : current width of the search
+            remaining_gates(int) : number of gates that still have to be mapped
+
+        Returns:
+            layers, width
+            layers(int) : number of layers to add to the tree. At least one
+                          if the tree has depth 0
+            width(int)  : width to use for the new nodes
+        """
+        progress = 1 - remaining_gates / max(self.total_gates, 1)
+        used = self.used()
+        if used < 0.75 * progress:
+            # Ahead of schedule, search deeper and wider
+            if depth < MAX_DEPTH:
+                return 2, min(width + 1, WIDTH)
+            return 1, min(width + 1, WIDTH)
+        if used > progress:
+            # Behind schedule, let the tree shrink
+            if depth > 1:
+                return 0, width
+            return 1, max(width - 1, 1)
+        return 1, width
+
+def route_directly(output, gates, front, layout, inverse, device):
+    """
+    Maps all remaining gates without searching: the qubits of a cnot of the
+    front layer are brought together along a shortest path, and this is
+    repeated until all gates are executed.
 
     Args:
-        gates(list)        : All still remaining gates
-        coupling(Coupling) : coupling for device topology
-        layout(dict)       : layout of the qubits
-        max_gates          : maximum number of gates to be searched through
+        output(DAGCircuit) : circuit the swaps and gates are appended to,
+                             or None
+        gates(dict)        : gates in the form returned by read_gates
+        front(FrontLayer)  : front layer, advanced in place
+        layout(list)       : layout of the qubits, modified in place
+        inverse(list)      : inverse of layout, modified in place
+        device(dict)       : device data as returned by get_device
 
     Returns:
-        executed_gates, remaining_gates, cnots
-        executed_gates(list)  : gates that can be executed
-        remaining_gates(list) : gates that cannot be executed
-        cnots(int)            : number of cnots in executed_gates
-    """
-    # qubits we can't use anymore, because we could not execute a cnot
-    # containing them
-    blocked_qubits = []
-    cnot_count = 0
-    executed_gates = []
-    remaining_gates = []
-
-    # the gates we are goning to seach through
-    interesting_gates = []
-    # the gates that are to far away, so we ignore them
-    ignored_gates = []
-    if len(gates)<=max_gates:
-        interesting_gates = gates
-    else:
-        interesting_gates = gates[:max_gates]
-        ignored_gates = gates[max_gates:]
-    for gate in interesting_gates:
-        if len(gate["qubits"]) == 1:
-            q = gate["qubits"][0]
-            if q in blocked_qubits:
-                remaining_gates.append(gate)
-            else:
-                executed_gates.append(gate)
-        else:
-            q1, q2 = qubits_from_cnot(gate)
-            if q1 not in blocked_qubits and q2 not in blocked_qubits and coupling.distance(layout[q1], layout[q2]) == 1:
-                executed_gates.append(gate)
-                cnot_count += 1
-            else:
-                remaining_gates.append(gate)
-                if q1 not in blocked_qubits:
-                    blocked_qubits.append(q1)
-                if q2 not in blocked_qubits:
-                    blocked_qubits.append(q2)
-    return executed_gates, remaining_gates + ignored_gates, cnot_count
+        The number of swaps inserted
+    """
+    distance = device["distance"]
+    qubits = device["qubits"]
+    swaps = 0
+    while front.remaining > 0:
+        for edge in shortest_path_swaps(front, layout, device):
+            apply_swap(layout, inverse, edge)
+            executed_gates, _ = front.execute([inverse[edge[0]], inverse[edge[1]]], distance, layout)
+            swaps += 1
+            if output != None:
+                append_swap(output, edge, device)
+                for g in executed_gates:
+                    append_gate(output, gates, g, layout, qubits)
+    return swaps
+
+def shortest_path_swaps(front, layout, device):
+    """ Returns the swaps that bring the qubits of the closest cnot of the
+        front layer together along a shortest path, moving the first qubit
+        towards the second"""
+    distance = device["distance"]
+    q1, q2 = min(front.upcoming_cnots(), key=lambda c: distance[layout[c[0]], layout[c[1]]])
+    p1, p2 = layout[q1], layout[q2]
+    edges = []
+    while distance[p1, p2] > 1:
+        step = next(int(p) for p in np.flatnonzero(distance[p1] == 1)
+                    if distance[p, p2] == distance[p1, p2] - 1)
+        edges.append((p1, step))
+        p1 = step
+    return edges
 
-def get_upcoming_cnots(gates, number_of_qubits, max_gates = 10000000):
+def score_swaps(upcoming_cnots, device, layout):
     """
+    Calculates for all swaps at once by how much they reduce the total distance
+    of the upcoming cnots.
+
     Args:
-        gates(list)      : gates to search for upcoming cnots
-        number_of_qubits : number of qubits in the coupling
-        max_gates        : maximum number of gates searched
-
-    Returns: a maximal list of cnot gates such that no qubit is contained twice
-             in a gate of the list and each qubit occures only in single qubit
-             gates before it occures in the list
-    """
-    upcoming_cnots = []
-    used_qubits = []
-    for i in range(len(gates)):
-        if i >= max_gates:
-            break
-        gate = gates[i]
-        if len(gate["qubits"])==2:
-            q1,q2 = qubits_from_cnot(gate)
-            if not (q1 in used_qubits or q2 in used_qubits):
-                upcoming_cnots.append(gate)
-            if q1 not in used_qubits:
-                used_qubits.append(q1)
-            if q2 not in used_qubits:
-                used_qubits.append(q2)
-            # if there is at most one qubit left, we won't find another cnot
-            if len(used_qubits) >= number_of_qubits - 1:
-                break
-    return upcoming_cnots
-
-def reverse_layout_lookup(layout, qubit):
-    """ Returns a qubit q such that layout[q] = qubit"""
-    for q in layout:
-        if layout[q]==qubit:
-            return q
-
-def calculate_total_distance(gates, coupling, layout):
-    """ Returns the sum of all the distances of two qubits in a cnot in gates
-        accordingto the layout and the coupling"""
-    dist = 0
-    for gate in gates:
-        if len(gate["qubits"]) == 2:
-            q1, q2 = qubits_from_cnot(gate)
-            dist += coupling.distance(layout[q1], layout[q2])
-    return dist
-
-def qubits_from_cnot(gate):
-    return gate["qubits"][0], gate["qubits"][1]
-
-def read_gates(circuit):
-    """
-    Reads all gates from the circuit. We do not use circuit.serial_layers()
-    because it is a lot slower and memory intensiv than this custom function.
-    This function should be improved to read more general circuits than those
-    provided in the challenge.
+        upcoming_cnots(list) : qubit pairs as returned by
+                               FrontLayer.upcoming_cnots
+        device(dict)         : device data as returned by get_device
+        layout(list)         : layout of the qubits before the swap
+
+    Returns:
+        numpy array containing for each swap in device["swaps"] the current
+        distance minus the distance after the swap
+    """
+    swaps = device["swaps"]
+    if upcoming_cnots == []:
+        return np.zeros(len(swaps), dtype=int)
+    distance = device["distance"]
+    # physical qubits of the cnots, as arrays of shape (1, cnots)
+    a = np.array([[layout[q1] for q1, _ in upcoming_cnots]])
+    b = np.array([[layout[q2] for _, q2 in upcoming_cnots]])
+    # the two ends of the swaps, as arrays of shape (swaps, 1)
+    p1 = swaps[:, :1]
+    p2 = swaps[:, 1:]
+    # Position of the cnot qubits after each swap, shape (swaps, cnots). Only
+    # cnots touching p1 or p2 change
+    trial_a = np.where(a == p1, p2, np.where(a == p2, p1, a))
+    trial_b = np.where(b == p1, p2, np.where(b == p2, p1, b))
+    return distance[a, b].sum() - distance[trial_a, trial_b].sum(axis=1)
+
+def apply_swap(layout, inverse, edge):
+    """ Swaps the logical qubits on the two physical qubits of edge in place"""
+    p1, p2 = edge
+    l1, l2 = inverse[p1], inverse[p2]
+    inverse[p1], inverse[p2] = l2, l1
+    layout[l1], layout[l2] = p2, p1
+
+
+class FrontLayer:
+    """
+    Keeps track of which gates of a circuit have already been executed.
+
+    Every logical qubit has a queue of the gates acting on it, in the order of
+    the circuit, and a head pointing to its first gate that was not executed
+    yet. A gate can be executed once it is at the head of the queues of all
+    its qubits. Cnots that are at the head of both queues but whose qubits are
+    not adjacent form the front layer; they block their qubits until a swap
+    brings them together. Since executing gates only moves heads forward,
+    it can be undone cheaply, which lets the tree search walk the tree with
+    a single FrontLayer.
+
+    For the lookahead, every qubit also has the list of its cnots and, for
+    each position of its queue, the number of cnots before it. So the cnots
+    after the head are found without scanning the queue.
+    """
+    __slots__ = ("qubits", "queues", "heads", "front", "remaining", "lookahead", "weights",
+                 "cnots", "partners", "ranks", "gain")
+
+    def __init__(self, gates, number_of_qubits, lookahead = LOOKAHEAD, decay = LOOKAHEAD_DECAY,
+                 gain = None):
+        """
+        Args:
+            gates(dict)           : gates in the form returned by read_gates
+            number_of_qubits(int) : number of qubits in the coupling
+            lookahead(int)        : number of cnots of each qubit after the
+                                    front layer counted by weighted_distance
+            decay(float)          : factor by which the weight of each
+                                    further cnot decays
+            gain(array)           : value of a cnot between each pair of
+                                    physical qubits, as returned by
+                                    get_device. If None, every cnot counts 1
+                                    in execute
+        """
+        self.gain = gain
+        self.qubits = gates["qubits"]
+        self.queues = [[] for _ in range(number_of_qubits)]
+        self.cnots = [[] for _ in range(number_of_qubits)]
+        self.partners = [[] for _ in range(number_of_qubits)]
+        self.ranks = [[0] for _ in range(number_of_qubits)]
+        for g, gate_qubits in enumerate(self.qubits):
+            for q in gate_qubits:
+                self.queues[q].append(g)
+                if len(gate_qubits) == 2:
+                    self.cnots[q].append(g)
+                    self.partners[q].append(gate_qubits[1] if q == gate_qubits[0] else gate_qubits[0])
+                self.ranks[q].append(len(self.cnots[q]))
+        self.heads = [0] * number_of_qubits
+        self.front = set()
+        self.remaining = len(self.qubits)
+        self.lookahead = lookahead
+        # Every cnot is seen from both of its qubits, hence the factor 0.5
+        self.weights = [0.5 * decay ** (k + 1) for k in range(lookahead)]
+
+    def undo(self, executed_gates, front):
+        """
+        Takes back the execution of gates.
+
+        Args:
+            executed_gates(list) : gates as returned by execute
+            front(set)           : the front layer before execute was called
+        """
+        for g in executed_gates:
+            for q in self.qubits[g]:
+                self.heads[q] -= 1
+        self.front = front
+        self.remaining += len(executed_gates)
+
+    def execute(self, touched, distance, layout):
+        """
+        Executes all gates that have become executable. Only gates on the
+        touched qubits and the gates they unblock are looked at, so the work
+        is proportional to the number of gates executed.
+
+        Args:
+            touched(iterable)   : logical qubits whose head may have become
+                                  executable, e.g. the qubits of a swap
+            distance(array)     : distance matrix of the coupling
+            layout(list)        : layout of the qubits
+
+        Returns:
+            executed_gates, cnots
+            executed_gates(list) : indices of the executed gates, in an order
+                                   in which they can be applied
+            cnots(float)         : number of cnots in executed_gates, each
+                                   weighted with its gain
+        """
+        qubits, queues, heads, front = self.qubits, self.queues, self.heads, self.front
+        gain = self.gain
+        executed_gates = []
+        cnots = 0
+        stack = list(touched)
+        while stack:
+            q = stack.pop()
+            if heads[q] == len(queues[q]):
+                continue
+            g = queues[q][heads[q]]
+            gate_qubits = qubits[g]
+            if len(gate_qubits) == 1:
+                heads[q] += 1
+                executed_gates.append(g)
+                stack.append(q)
+                continue
+            q1, q2 = gate_qubits
+            # The cnot is only ready if it is at the head of both queues
+            other = q2 if q == q1 else q1
+            if heads[other] == len(queues[other]) or queues[other][heads[other]] != g:
+                continue
+            if distance[layout[q1], layout[q2]] == 1:
+                front.discard(g)
+                heads[q1] += 1
+                heads[q2] += 1
+                executed_gates.append(g)
+                cnots += 1 if gain is None else gain[layout[q1], layout[q2]]
+                stack.append(q1)
+                stack.append(q2)
+            else:
+                front.add(g)
+        self.remaining -= len(executed_gates)
+        return executed_gates, cnots
+
+    def add_gate(self, g):
+        """ Adds the gate g, which was appended to the gates, to the end of
+            the queues of its qubits"""
+        gate_qubits = self.qubits[g]
+        for q in gate_qubits:
+            self.queues[q].append(g)
+            if len(gate_qubits) == 2:
+                self.cnots[q].append(g)
+                self.partners[q].append(gate_qubits[1] if q == gate_qubits[0] else gate_qubits[0])
+            self.ranks[q].append(len(self.cnots[q]))
+        self.remaining += 1
+
+    def execute_bridge(self, g, distance, layout, gain = 1):
+        """
+        Executes the cnot g of the front layer, whose qubits are not
+        adjacent, by a bridge, and then all gates that become executable.
+
+        Args:
+            g(int)          : the cnot
+            distance(array) : distance matrix of the coupling
+            layout(list)    : layout of the qubits
+            gain(float)     : value of the bridge, see "bridge_gain" of
+                              get_device
+
+        Returns:
+            executed_gates, cnots as returned by execute, with g first
+        """
+        q1, q2 = self.qubits[g]
+        self.front.discard(g)
+        self.heads[q1] += 1
+        self.heads[q2] += 1
+        self.remaining -= 1
+        executed_gates, cnots = self.execute([q1, q2], distance, layout)
+        return [g] + executed_gates, cnots + gain
+
+    def weighted_distance(self, distance, layout):
+        """
+        Returns the sum of the distances of the qubits of the cnots in the
+        front layer, plus the distances of the next lookahead cnots of every
+        qubit, weighted with decaying weights.
+
+        Args:
+            distance(array) : distance matrix of the coupling
+            layout(list)    : layout of the qubits
+        """
+        qubits, front = self.qubits, self.front
+        dist = 0
+        for g in front:
+            q1, q2 = qubits[g]
+            dist += distance[layout[q1], layout[q2]]
+        if self.lookahead == 0:
+            return dist
+        weights, cnots, partners = self.weights, self.cnots, self.partners
+        for q, head in enumerate(self.heads):
+            r = self.ranks[q][head]
+            for k, g in enumerate(cnots[q][r:r + self.lookahead]):
+                if g not in front:
+                    dist += weights[k] * distance[layout[q], layout[partners[q][r + k]]]
+        return dist
+
+    def upcoming_cnots(self):
+        """ Returns the qubit pairs of the cnots in the front layer, i.e. a
+            maximal list of cnot gates such that no qubit is contained twice
+            in a gate of the list and each qubit occures only in executed
+            gates before"""
+        return [self.qubits[g] for g in self.front]
+
+def read_gates(circuit, index):
+    """
+    Reads all gates from the circuit by walking the DAG in topological order.
+    We do not use circuit.serial_layers() or circuit.qasm() because they are a
+    lot slower and memory intensiv than this custom function. Barriers are
+    skipped, since the mapper keeps the order of the gates on every qubit
+    anyway, and measurements are collected separately and done at the end.
+    This is only correct if no gate follows a measurement on its qubit, so
+    such circuits are rejected.
 
     Args:
         circuit(DAGCircuit): The DAGCircuit object to read the gates from
+        index(dict)        : maps the qubits in the form (Register, Index) to
+                             their integer index
 
     Returns:
-        A list of all gates in the circuit in an order such that, executed in
-        that order, they yield a circuit equivalent to the original circuit.
-        A gate is a dictionary with the fields
-            "qasm"  : The qasm instruction without the qubits it is applied to
-            "qubits": List of qubits the gate is applied to. Each qubit is in
-                      the form (Register, Index)
-    """
-    ignored_lines = 15  #The first 15 lines are declarations, ignore them
-    gates = []
-    lines = circuit.qasm().splitlines()
-    l = ignored_lines
-    while True:
-        if(lines[l][:7]=="barrier"):    #We assume there are no gates after the first barrier
-            break
-        line_split = lines[l].split(" ")
-        qubit_split = line_split[1][:-1].split(",")
-        g = { "qasm"  : line_split[0],
-              "qubits": [string_to_qubit(q) for q in qubit_split] }
-        gates.append(g)
-        l += 1
-    return gates
+        The gates of the circuit in an order such that, executed in that
+        order, they yield a circuit equivalent to the original circuit. They
+        are stored column wise, in a dictionary with the fields
+            "names"    : List of the names of all operations in the circuit.
+                         An operation is refered to by its position in it
+            "ops"      : For each gate, the index of its operation in "names"
+            "qubits"   : For each gate, the tuple of the integer indices of the
+                         qubits the gate is applied to
+            "params"   : For each gate, the tuple of its parameters
+            "measures" : List of pairs (qubit, clbit) of the measurements,
+                         with the qubit as integer index and the clbit in the
+                         form (Register, Index)
 
-def string_to_qubit(qubit_string):
-    """ Converts a string of the form '<register>[<index>]' to the pair
-    (register, index)"""
-    splits = qubit_string.split("[")
-    return (splits[0], int(splits[1][:-1]))
+    Raises:
+        MapperError: if the circuit has conditional gates or gates on a
+                     qubit after its measurement
+    """
+    gates = {"names": [], "ops": [], "qubits": [], "params": [], "measures": []}
+    op_ids = {}
+    measured = set()
+    graph = circuit.multi_graph
+    for n in nx.topological_sort(graph):
+        nd = graph.node[n]
+        if nd["type"] != "op" or nd["name"] == "barrier":
+            continue
+        if nd["condition"] != None:
+            raise MapperError("conditional gates are not supported")
+        if nd["name"] == "measure":
+            gates["measures"].append((index[nd["qargs"][0]], nd["cargs"][0]))
+            measured.add(nd["qargs"][0])
+            continue
+        if len(nd["qargs"]) > 2:
+            raise MapperError("gates on more than two qubits are not supported")
+        if not measured.isdisjoint(nd["qargs"]):
+            raise MapperError("gates after the measurement of their qubit are not supported")
+        if nd["name"] not in op_ids:
+            op_ids[nd["name"]] = len(gates["names"])
+            gates["names"].append(nd["name"])
+        gates["ops"].append(op_ids[nd["name"]])
+        gates["qubits"].append(tuple(index[q] for q in nd["qargs"]))
+        gates["params"].append(tuple(nd["params"]))
+    return gates
 
-def gate_to_qasm(gate, layout):
+def new_output_circuit(circuit, qubits):
     """
-    Converts a gate to a qasm string using the give layout
+    Creates an empty DAGCircuit on the physical qubits, that has the classical
+    registers, the basis and the gate definitions of circuit. Thereby it looks
+    like the output of the Unroller, which the later compiler passes expect.
 
     Args:
-        gate(dict)  : a gate in the form returned by read_gates
-        layout(dict): mapping from current qubit names to the qubit names
-                      actually written
+        circuit(DAGCircuit): The circuit that is mapped
+        qubits(list)       : the physical qubits in the form (Register, Index)
 
     Returns:
-        the qasm instruction for this gate as string
-    """
-    qasm_str = gate["qasm"]
-    qasm_str += " "
-    for q in gate["qubits"]:
-        qasm_str += "%s[%d],"%layout[q]
-    qasm_str = qasm_str[:-1] + ";\n"
-    return qasm_str
-
-def qubit_to_measure_string(q, layout, c_index):
-    """ Returns the instructions that measures the qubit layout[q] into the
-        classical register at index c_index as qasm string"""
-    return "measure %s[%d] -> c[%s];\n" % (layout[q][0], layout[q][1], c_index)
+        the empty DAGCircuit
+    """
+    output = DAGCircuit()
+    qregs = {}
+    for register, i in qubits:
+        qregs[register] = max(qregs.get(register, 0), i + 1)
+    for register, size in sorted(qregs.items()):
+        output.add_qreg(register, size)
+    for register, size in sorted(circuit.cregs.items()):
+        output.add_creg(register, size)
+    for name, signature in circuit.basis.items():
+        output.add_basis_element(name, *signature)
+    for name, gate_data in circuit.gates.items():
+        output.add_gate_data(name, gate_data)
+    # The swaps, the final barrier and the measurements need these
+    if "cx" not in output.basis:
+        output.add_basis_element("cx", 2)
+    if "barrier" not in output.basis:
+        output.add_basis_element("barrier", -1)
+    if "measure" not in output.basis:
+        output.add_basis_element("measure", 1, 1)
+    return output
+
+def append_gate(output, gates, g, layout, qubits):
+    """
+    Appends a gate to the output circuit using the give layout
+
+    Args:
+        output(DAGCircuit) : the circuit to append to
+        gates(dict)        : gates in the form returned by read_gates
+        g(int)             : index of the gate
+        layout(list)       : mapping from logical to physical qubit indices
+        qubits(list)       : the physical qubits in the form (Register, Index)
+    """
+    output.apply_operation_back(gates["names"][gates["ops"][g]],
+                                [qubits[layout[q]] for q in gates["qubits"][g]],
+                                params=list(gates["params"][g]))
+
+def append_bridge(output, gates, g, layout, device):
+    """ Appends the cnot g, whose qubits are at distance two, to the output
+        circuit as a bridge of four cnots over the qubit between them where
+        it is cheapest"""
+    qubits = device["qubits"]
+    control, target = (layout[q] for q in gates["qubits"][g])
+    middle = device["bridge_middle"][control, target]
+    a, m, c = qubits[control], qubits[middle], qubits[target]
+    output.apply_operation_back("cx", [a, m])
+    output.apply_operation_back("cx", [m, c])
+    output.apply_operation_back("cx", [a, m])
+    output.apply_operation_back("cx", [m, c])
+
+def append_swap(output, edge, device):
+    """ Appends a swap of the physical qubits in edge to the output circuit,
+        expanded into three cnots, see swap_cnots"""
+    qubits = device["qubits"]
+    for a, b in swap_cnots(edge, device):
+        output.apply_operation_back("cx", [qubits[a], qubits[b]])
+
+def swap_cnots(edge, device):
+    """ Returns the three cnots, as pairs (control, target), of a swap of the
+        physical qubits in edge. Two of them go in the cheaper direction,
+        e.g. along the direction of the coupling, so that only one has to be
+        reversed by the direction mapper"""
+    p1, p2 = edge
+    if device["gain"][p1, p2] < device["gain"][p2, p1]:
+        p1, p2 = p2, p1
+    return [(p1, p2), (p2, p1), (p1, p2)]
@@ -0,0 +1,99 @@
+# Checks that the fast paths of challenge_evaluation give the same results as
+# the code they replace: the reader of flat circuits and the state
+# permutation. Run it from the directory of the repository:
+#
+#     python check_evaluation.py
+
+from challenge_evaluation import _read_flat_qasm, _get_perm
+import qiskit
+from qiskit.unroll import Unroller, DAGBackend
+from glob import glob
+from itertools import permutations
+import numpy as np
+import sys
+
+BASIS_GATES = 'u1,u2,u3,cx,id'
+
+# Flat circuits that use the less common parts of the syntax
+EXTRA_CIRCUITS = [
+    'OPENQASM 2.0;include "qelib1.inc";qreg q[2];creg c[2];u2(-pi,+.5e1) q[0];u1(0) q[1];'
+    'u2(-0,3) q[1];barrier q;measure q->c;',
+    'OPENQASM 2.0;\n// comment\ninclude "qelib1.inc";qreg q[2];qreg r[1];creg c[2];\n'
+    'u1(2) r[0]; cx q[1],\n r[0];id q[0];measure q[1] -> c[0];',
+]
+
+
+def unrolled(qasm_string):
+    """Read a circuit with the full parser and unroller."""
+    program_node_circuit = qiskit.qasm.Qasm(data=qasm_string).parse()
+    return Unroller(program_node_circuit, DAGBackend(BASIS_GATES.split(","))).execute()
+
+
+def dag_contents(dag_circuit):
+    """Everything of a DAGCircuit the evaluation and the compilers look at."""
+    return {"basis": list(dag_circuit.basis.items()),
+            "gates": [(name, _gate_data(data)) for name, data in dag_circuit.gates.items()],
+            "qregs": dict(dag_circuit.qregs),
+            "cregs": dict(dag_circuit.cregs),
+            "nodes": sorted(dag_circuit.multi_graph.nodes(data=True)),
+            "edges": sorted(dag_circuit.multi_graph.edges(data=True)),
+            "qasm": dag_circuit.qasm()}
+
+
+def _gate_data(data):
+    """The data of a gate definition, with the body in QASM form."""
+    data = dict(data)
+    if data.get("body") is not None:
+        data["body"] = data["body"].qasm()
+    return data
+
+
+def check_flat_qasm():
+    """Compare _read_flat_qasm with the parser on the circuits of the repository."""
+    failures = 0
+    circuits = [(name, open(name).read()) for name in sorted(glob('circuits/*.qasm'))]
+    circuits += [("extra %d" % i, qasm) for i, qasm in enumerate(EXTRA_CIRCUITS)]
+    for name, qasm_string in circuits:
+        fast = _read_flat_qasm(qasm_string, BASIS_GATES)
+        if fast is None:
+            print("%s: not flat, read by the parser" % name)
+            continue
+        expected, actual = dag_contents(unrolled(qasm_string)), dag_contents(fast)
+        different = [field for field in expected if expected[field] != actual[field]]
+        if different:
+            failures += 1
+            print("%s: _read_flat_qasm differs in %s" % (name, ", ".join(different)))
+    return failures
+
+
+def string_perm(perm):
+    """The string based implementation _get_perm replaced."""
+    n = len(perm)
+    res = np.arange(2**n)
+    for num_ind in range(2**n):
+        ss_orig = [digit for digit in bin(num_ind)[2:].zfill(n)]
+        ss_final = ss_orig.copy()
+        for ii in range(n):
+            ss_final[n-1-ii] = ss_orig[n-1-perm[ii]]
+        res[num_ind] = int(''.join(ss_final), 2)
+    return list(res)
+
+
+def check_get_perm(max_qubits=10, samples=20):
+    """Compare _get_perm with string_perm on all permutations of up to four qubits and on
+    random permutations of up to max_qubits qubits."""
+    failures = 0
+    rng = np.random.RandomState(0)
+    perms = [list(perm) for n in range(1, 5) for perm in permutations(range(n))]
+    perms += [list(rng.permutation(n)) for n in range(5, max_qubits + 1) for _ in range(samples)]
+    for perm in perms:
+        if list(_get_perm(perm)) != string_perm(perm):
+            failures += 1
+            print("_get_perm differs for %s" % perm)
+    return failures
+
+
+if __name__ == '__main__':
+    failures = check_flat_qasm() + check_get_perm()
+    print("%d failures" % failures)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,84 @@
+# Checks that the compiler of challenge_submission keeps to its budgets.
+# Run it from the directory of the repository:
+#
+#     python check_submission.py
+
+from challenge_evaluation import load_coupling
+from challenge_submission import Budget, WIDTH, compiler_function, my_swap_mapper
+from check_evaluation import unrolled
+import sys
+import time
+
+CIRCUIT = 'circuits/random0_n16_d16.qasm'
+COUPLING = 'rect_rand_q16'
+# A circuit for which the single qubit simplification of QISKit takes far
+# longer than the search, and the seconds compiling it may exceed its time
+# budget by for the unrolling and direction_mapper
+LARGE_CIRCUIT = 'circuits/random0_n20_d20.qasm'
+LARGE_COUPLING = 'rect_rand_q20'
+TIME_SLACK = 1.5
+
+
+def cnots_on_coupling(dag_circuit, coupling_map):
+    """Whether every cnot of a mapped circuit acts on an edge of the coupling, in either
+    direction."""
+    edges = {(a, b) for a, targets in coupling_map.items() for b in targets}
+    for _, node in dag_circuit.multi_graph.nodes(data=True):
+        if node["type"] == "op" and node["name"] == "cx":
+            a, b = (qubit[1] for qubit in node["qargs"])
+            if (a, b) not in edges and (b, a) not in edges:
+                return False
+    return True
+
+
+def check_beam_node_budget(node_budget=200):
+    """Map a circuit with the beam search once without and once with a small node budget.
+    The small budget must stop the search after about node_budget scored candidates and
+    still give a circuit on the coupling."""
+    failures = 0
+    dag_circuit = unrolled(open(CIRCUIT).read())
+    coupling_map = load_coupling(COUPLING)["coupling_map"]
+    nodes = {}
+    for limit in (None, node_budget):
+        budget = Budget(node_budget=limit)
+        mapped = my_swap_mapper(dag_circuit, coupling_map, engine="beam", budget=budget)
+        nodes[limit] = budget.nodes
+        if not cnots_on_coupling(mapped, coupling_map):
+            failures += 1
+            print("beam search with node budget %s: cnot off the coupling" % limit)
+    print("beam search: %d nodes unlimited, %d with a budget of %d"
+          % (nodes[None], nodes[node_budget], node_budget))
+    # the budget is checked before every partial solution is extended
+    if nodes[node_budget] > node_budget + WIDTH or nodes[node_budget] >= nodes[None]:
+        failures += 1
+        print("beam search ignores the node budget")
+    return failures
+
+
+def check_time_budget(time_budget=2):
+    """Compile a large circuit with a tight time budget, which must bound the wall time.
+    The compiled circuit must still respect the directions of the coupling."""
+    failures = 0
+    dag_circuit = unrolled(open(LARGE_CIRCUIT).read())
+    coupling_map = load_coupling(LARGE_COUPLING)["coupling_map"]
+    start = time.monotonic()
+    compiled = compiler_function(dag_circuit, coupling_map, time_budget=time_budget)
+    elapsed = time.monotonic() - start
+    print("compiling with a time budget of %gs took %.2fs" % (time_budget, elapsed))
+    if elapsed > time_budget + TIME_SLACK:
+        failures += 1
+        print("the time budget does not bound the compilation")
+    edges = {(a, b) for a, targets in coupling_map.items() for b in targets}
+    for _, node in compiled.multi_graph.nodes(data=True):
+        if node["type"] == "op" and node["name"] == "cx":
+            if tuple(qubit[1] for qubit in node["qargs"]) not in edges:
+                failures += 1
+                print("compiled cnot against the direction of the coupling")
+                break
+    return failures
+
+
+if __name__ == '__main__':
+    failures = check_beam_node_budget() + check_time_budget()
+    print("%d failures" % failures)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+
+"""
+On-disk cache of compiled circuits, used by compiler_function and by the
+evaluation so that compiling the same circuit for the same coupling map with
+the same settings again only reads the earlier result.
+"""
+
+from functools import lru_cache, partial
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+import types
+import zlib
+
+# Maximum total size of the files of a cache in bytes. If it is exceeded, the
+# least recently used entries are removed
+CACHE_SIZE = 256 << 20
+# Suffix of the files of the cache entries
+CACHE_SUFFIX = ".dag"
+
+class ResultCache:
+    """
+    Content addressed cache of compiled circuits in a directory. Every entry
+    is stored in its own file, named by the hash of the circuit, the
+    coupling map and the settings of the compiler, and holds the compiled
+    circuit and the time it took to compile, pickled and compressed.
+
+    The files are written atomically, so several processes may share a
+    cache directory. Reading an entry marks it as recently used by touching
+    its file.
+
+    The total size is read from the directory once and then counted up by
+    the entries this object writes, so the directory is only listed again
+    when the size exceeds max_bytes. Entries written by other processes are
+    only noticed then, so a shared directory may grow beyond max_bytes by
+    what the other processes wrote in the meantime.
+
+    Attributes:
+        directory(str) : the directory of the cache
+        max_bytes(int) : maximum total size of the entries
+        size(int)      : the total size of the entries, as far as known
+    """
+
+    def __init__(self, directory, max_bytes = CACHE_SIZE):
+        """
+        Args:
+            directory(str) : the directory of the cache, created if it does
+                             not exist
+            max_bytes(int) : maximum total size of the entries
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok = True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def key(self, dag_circuit, coupling_map, settings):
+        """
+        Computes the key of a compilation.
+
+        Args:
+            dag_circuit(DAGCircuit) : the circuit to compile
+            coupling_map(dict)      : coupling map for device topology
+            settings(dict)          : everything else the result depends on,
+                                      e.g. the gate costs and the options of
+                                      the compiler. Its values must have a
+                                      deterministic repr
+
+        Returns:
+            str : the hexadecimal hash of the gate list of the circuit, the
+                  coupling map and the settings
+        """
+        digest = hashlib.sha256()
+        digest.update(repr(circuit_fingerprint(dag_circuit)).encode())
+        coupling = None
+        if coupling_map != None:
+            coupling = sorted((control, sorted(targets)) for control, targets in coupling_map.items())
+        digest.update(repr(coupling).encode())
+        digest.update(repr(sorted((name, _normalize(value)) for name, value in settings.items())).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Looks up a compilation.
+
+        Args:
+            key(str) : the key of the compilation, see key
+
+        Returns:
+            (DAGCircuit, float) : the compiled circuit and the time its
+                                  compilation took, or None if the cache has
+                                  no entry for key
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+            os.utime(path)
+        except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+            return None
+        return entry["dag"], entry["time"]
+
+    def put(self, key, dag_circuit, compile_time = 0):
+        """
+        Stores a compilation and evicts the least recently used entries if
+        the cache got too large.
+
+        Args:
+            key(str)                : the key of the compilation, see key
+            dag_circuit(DAGCircuit) : the compiled circuit
+            compile_time(float)     : the time the compilation took
+        """
+        data = zlib.compress(pickle.dumps({"dag": dag_circuit, "time": compile_time},
+                                          pickle.HIGHEST_PROTOCOL))
+        handle, temporary = tempfile.mkstemp(dir = self.directory)
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        os.replace(temporary, self._path(key))
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits into
+            max_bytes"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+        self.size = total
+
+    def _entries(self):
+        """ Returns the time of the last use, the size and the name of the
+            file of every entry"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(CACHE_SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+def circuit_fingerprint(dag_circuit):
+    """
+    Normalizes a circuit for hashing. Two circuits with the same registers
+    and the same gates in the same order have the same fingerprint.
+
+    Args:
+        dag_circuit(DAGCircuit) : the circuit
+
+    Returns:
+        tuple : the registers and the list of the gates, each given by its
+                name, qubits, classical bits, parameters and condition
+    """
+    graph = dag_circuit.multi_graph
+    gates = [(nd["name"], tuple(nd["qargs"]), tuple(nd["cargs"]),
+              tuple(str(p) for p in nd["params"]), nd["condition"])
+             for n, nd in sorted(graph.nodes(data = True)) if nd["type"] == "op"]
+    return (sorted(dag_circuit.qregs.items()), sorted(dag_circuit.cregs.items()), gates)
+
+def code_fingerprint(function):
+    """
+    Identifies the code of a compiler, so that entries of the cache become
+    stale when the compiler is changed and compilers that differ do not
+    share entries.
+
+    A function is identified by its bytecode, constants, defaults, the
+    values of its closure and the source of its module, and by the
+    functions and modules it refers to by name, recursively. A functools.partial is identified by its function and
+    arguments, and a class by its module and name and the source of its
+    module. Other callables, and values of closures or arguments that have
+    no stable identity, e.g. arbitrary objects, have no fingerprint.
+
+    Args:
+        function(callable) : the compiler
+
+    Returns:
+        tuple : the fingerprint, or None if the compiler has none and its
+                results must not be cached
+    """
+    try:
+        return _fingerprint(function, set())
+    except _NoFingerprint:
+        return None
+
+class _NoFingerprint(Exception):
+    """ Raised by _fingerprint for values without a stable identity"""
+    pass
+
+def _fingerprint(value, visiting):
+    """ Returns the fingerprint of value for code_fingerprint. visiting holds
+        the ids of the functions whose fingerprint is being computed, to stop
+        at recursive references"""
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        return value
+    if isinstance(value, (tuple, list, set, frozenset)):
+        items = [_fingerprint(item, visiting) for item in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort(key = repr)
+        return (type(value).__name__, tuple(items))
+    if isinstance(value, dict):
+        return ("dict", tuple(sorted(((_fingerprint(k, visiting), _fingerprint(v, visiting))
+                                      for k, v in value.items()), key = repr)))
+    if isinstance(value, types.ModuleType):
+        return ("module", value.__name__, _file_hash(getattr(value, "__file__", None)))
+    if isinstance(value, partial):
+        return ("partial", _fingerprint(value.func, visiting), _fingerprint(value.args, visiting),
+                _fingerprint(value.keywords, visiting))
+    if isinstance(value, types.CodeType):
+        return ("code", value.co_code, value.co_names, value.co_varnames,
+                tuple(_fingerprint(c, visiting) for c in value.co_consts))
+    if isinstance(value, type):
+        module = inspect.getmodule(value)
+        source = getattr(module, "__file__", None)
+        if source == None:
+            raise _NoFingerprint()
+        return ("class", module.__name__, value.__qualname__, _file_hash(source))
+    if isinstance(value, types.FunctionType):
+        if id(value) in visiting:
+            return ("recursive", value.__module__, value.__qualname__)
+        visiting.add(id(value))
+        code = value.__code__
+        closure = [cell.cell_contents for cell in value.__closure__ or ()]
+        # The functions, classes and modules the code refers to by name.
+        # Other globals are data, which the source of the module covers, if
+        # there is one
+        referenced = []
+        for name in _global_names(code):
+            if name in value.__globals__:
+                target = value.__globals__[name]
+                if isinstance(target, (types.FunctionType, types.ModuleType, type, partial)):
+                    referenced.append((name, _fingerprint(target, visiting)))
+        module = inspect.getmodule(value)
+        fingerprint = ("function", value.__module__, value.__qualname__,
+                       _file_hash(getattr(module, "__file__", None)), _fingerprint(code, visiting), _fingerprint(value.__defaults__, visiting),
+                       _fingerprint(value.__kwdefaults__, visiting),
+                       _fingerprint(closure, visiting), tuple(referenced))
+        visiting.discard(id(value))
+        return fingerprint
+    raise _NoFingerprint()
+
+def _global_names(code):
+    """ Returns the names code and the code objects nested in it use, which
+        may refer to globals"""
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            names |= _global_names(constant)
+    return sorted(names)
+
+@lru_cache(maxsize = None)
+def _file_hash(path):
+    """ Returns the hash of the contents of a file, None if there is none"""
+    if path == None or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _normalize(value):
+    """ Turns dictionaries into sorted lists, so that their repr does not
+        depend on the order of insertion"""
+    if isinstance(value, dict):
+        return sorted((k, _normalize(v)) for k, v in value.items())
+    return value
@@ -10,8 +10,8 @@ WIDTH = 4
 DEPTH = 3
 MAX_GATES = 200
 
-def my_swap_mapper_tree(circuit_graph, coupling):
-    random.seed(123)
+def my_swap_mapper_tree(circuit_graph, coupling, seed = 123):
+    rng = random.Random(seed)
     gates = read_gates(circuit_graph)
     #gates = circuit_graph.serial_layers()
     qubits = coupling.get_qubits()
@@ -26,7 +26,7 @@ def my_swap_mapper_tree(circuit_graph, coupling):
     gates = gates[:count]"""
 
     qasm_string = ""
-    node = build_tree(None, gates, coupling, layout, DEPTH + 1, width = WIDTH)
+    node = build_tree(None, gates, coupling, layout, DEPTH + 1, rng, width = WIDTH)
     run = True
     while run:
         run = node["remaining_gates"] != []
@@ -44,7 +44,7 @@ def my_swap_mapper_tree(circuit_graph, coupling):
             if n["score"] == node["score"]:
                 node = n
                 break
-        update_tree(node, coupling, width=WIDTH)
+        update_tree(node, coupling, rng, width=WIDTH)
 
     swap_decl = "gate swap a,b { cx a,b; cx b,a; cx a,b;}"
     """end_nodes_qasm = ""
@@ -69,7 +69,7 @@ def my_swap_mapper_tree(circuit_graph, coupling):
 def score_swap(gates, upcoming_cnots, coupling, layout):
     return calculate_total_distance(upcoming_cnots, coupling, layout)
 
-def do_tree_step(node, coupling, depth, width=WIDTH):
+def do_tree_step(node, coupling, depth, rng, width=WIDTH):
     upcoming_cnots = get_upcoming_cnots(node["remaining_gates"], len(coupling.get_qubits()))
     #ordered_swaps = []
     layout = node["layout"]
@@ -99,21 +99,21 @@ def do_tree_step(node, coupling, depth, width=WIDTH):
     for i in range(min(width, len(coupling.get_edges()))):
         while d not in swaps_by_distance or swaps_by_distance[d] == []:
             d -= 1
-        r = random.randrange(len(swaps_by_distance[d]))
+        r = rng.randrange(len(swaps_by_distance[d]))
         ordered_swaps.append(swaps_by_distance[d][r])
         del swaps_by_distance[d][r]
 
     score = -10000
     next_nodes = []
     for i in range(min(width, len(ordered_swaps))):
-        n = build_tree(ordered_swaps[i]["edge"], node["remaining_gates"], coupling, ordered_swaps[i]["layout"], depth-1, width=width, cnot_count = node["cnots"])
+        n = build_tree(ordered_swaps[i]["edge"], node["remaining_gates"], coupling, ordered_swaps[i]["layout"], depth-1, rng, width=width, cnot_count = node["cnots"])
         next_nodes.append(n)
         #print("examining swap "+str(depth)+ " "+str(ordered_swaps[i]["edge"])+", score: "+str(n["score"]))
         if n["score"] > score:
             score = n["score"]
     return score, next_nodes
 
-def build_tree(swap, gates, coupling, layout, depth, width = WIDTH, cnot_count = 0):
+def build_tree(swap, gates, coupling, layout, depth, rng, width = WIDTH, cnot_count = 0):
     node = {}
     node["swap"] = swap
     node["layout"] = layout
@@ -130,16 +130,16 @@ def build_tree(swap, gates, coupling, layout, depth, width = WIDTH, cnot_count =
         node["next_nodes"] = None
         return node
 
-    node["score"], node["next_nodes"] = do_tree_step(node, coupling, depth, width)
+    node["score"], node["next_nodes"] = do_tree_step(node, coupling, depth, rng, width)
     return node
 
-def update_tree(node, coupling, width = WIDTH):
+def update_tree(node, coupling, rng, width = WIDTH):
     if node["next_nodes"] == None:
-        node["score"], node["next_nodes"] = do_tree_step(node, coupling, 2, width)
+        node["score"], node["next_nodes"] = do_tree_step(node, coupling, 2, rng, width)
     else:
         node["score"] = -10000
         for n in node["next_nodes"]:
-            update_tree(n, coupling, width=width)
+            update_tree(n, coupling, rng, width=width)
             if n["score"] > node["score"]:
                 node["score"] = n["score"]
 